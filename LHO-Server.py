@@ -18,6 +18,9 @@ def func(n):  ## creates all our EPIC variables
         dic[starter + "MIN"] = {'prec' : 3}  ## min value of station
         dic[starter + "MAX"] = {'prec' : 3}  ## max value of station
         dic[starter + "MEAN"] = {'prec' : 3}  ## mean value of station
+        dic[starter + "LATENCY"] = {'prec' : 1}  ## median latency (s) of the data of station
+        dic[starter + "LATENCY_P95"] = {'prec' : 1}  ## 95th percentile of the latency (s) of station
+        dic[starter + "GAPS"] = {'type' : 'int'}  ## gaps in the data of station
         dic[starter + "ID"] = {'type' : 'int'}  ## hex value of string
         dic[starter + "NAME"] = {'type' : 'str'}  ## string version of ID
         dicts.append(dic)
@@ -34,10 +37,10 @@ def func(n):  ## creates all our EPIC variables
     dic["NETWORK_AUX1"] = {'type' : 'int'}
     dicts.append(dic)
     dic = {}
-    dic["NETWORK_AUX2"] = {'type' : 'int'}
+    dic["NETWORK_AUX2"] = {'type' : 'int'}  ## GPS time of the arrival of the located earthquake at the site
     dicts.append(dic)
     dic = {}
-    dic["NETWORK_AUX3"] = {'type' : 'int'}
+    dic["NETWORK_AUX3"] = {'type' : 'int'}  ## seconds until that arrival (lead time)
     dicts.append(dic)
         
     #heartbeat to check the uptime of the picket fence code
@@ -8,6 +8,7 @@ Created on Tue Jul 12 16:53:05 2022
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from Picket_fence_code_v2 import PicketFence, picketFenceArguments
+from Picket_fence_replay import picketFenceReplay
 import logging
 
 
@@ -20,6 +21,44 @@ def main():
                         help='show verbose debugging output')
     parser.add_argument('--epics', default=False, action="store_true",
                         dest="epics", help="set EPICS variables in IOC")
+    parser.add_argument('--headless', default=False, action="store_true",
+                        dest="headless", help="run the detection and EPICS output without the display")
+    parser.add_argument('--seedlink-server', default=None, dest="seedlink_server",
+                        help="download every station from this server instead of its preferred one, e.g. localhost:18000 "
+                        "for Picket_fence_seedlink_emulator.py")
+    parser.add_argument('--redundant-servers', default=False, action="store_true", dest="redundant_servers",
+                        help="also download the stations from the other servers in their 'Servers' (IRIS rtserve for the US and "
+                        "IU stations), the first copy of each packet is used")
+    parser.add_argument('--gap-grace', default=20, type=float, dest="gap_grace",
+                        help="with --redundant-servers, seconds a packet after a gap waits for another server to send the missing data")
+    parser.add_argument('--replay', default=None, nargs='+',
+                        help="run over these miniSEED files or directories instead of the SeedLink servers")
+    parser.add_argument('--speed', default=1.0, type=float,
+                        help="speed of the replay compared to real time, 0 runs it as fast as possible")
+    parser.add_argument('--checkpoint', default=None, dest="checkpoint_file",
+                        help="file where the data and filter states are saved, a restart continues from it")
+    parser.add_argument('--statefile', default=None, dest="statefile_prefix",
+                        help="prefix of the files where the SeedLink sequence numbers are saved, a restart resumes from them")
+    parser.add_argument('--metrics-port', default=None, type=int, dest="metrics_port",
+                        help="serve the data latency of every station and server as JSON on this port of localhost")
+    parser.add_argument('--filter-init', default='taper', choices=['taper', 'steady'], dest="filter_init",
+                        help="'taper' starts the filter of a new station at rest and discards its first 180 s, 'steady' starts it "
+                        "in the steady state of its first samples and discards only 10 s")
+    parser.add_argument('--packet-detection', default=False, action='store_true', dest="packet_detection",
+                        help="also check every packet against the thresholds as soon as it arrives, instead of only every update")
+    parser.add_argument('--association', default=False, action='store_true',
+                        help="confirm the triggers of several stations with the travel time between them, a station that "
+                        "triggers alone is shown as a glitch")
+    parser.add_argument('--traveltime-grid', default=None, dest="traveltime_file",
+                        help="prefix of the files where the travel-time grid used to locate the events is kept, "
+                        "without it the grid is computed at every start")
+    parser.add_argument('--level-hold-time', default=0, type=float, dest="level_hold_time",
+                        help="seconds a station keeps its color after it last reached it, 0 follows the data")
+    parser.add_argument('--render-mode', default='blit', choices=['blit', 'full'], dest="render_mode",
+                        help="'blit' only redraws the traces on every update, 'full' rebuilds the whole figure")
+    parser.add_argument('--epics-backend', default='auto', choices=['auto', 'pyepics', 'caput', 'pcaspy'],
+                        dest="epics_backend", help="how EPICS variables are written, 'auto' uses pyepics if installed, "
+                        "'pcaspy' serves the EPICS variables from this process instead of LHO-Server.py/LLO-Server.py")
 
     # parse the arguments
     runtimeArgs = parser.parse_args()
@@ -28,6 +67,19 @@ def main():
     args=picketFenceArguments()
     args.verbose=runtimeArgs.verbose
     args.send_epics=runtimeArgs.epics
+    args.headless=runtimeArgs.headless
+    args.epics_backend=runtimeArgs.epics_backend
+    args.render_mode=runtimeArgs.render_mode
+    args.checkpoint_file=runtimeArgs.checkpoint_file
+    args.statefile_prefix=runtimeArgs.statefile_prefix
+    args.metrics_port=runtimeArgs.metrics_port
+    args.filter_init=runtimeArgs.filter_init
+    args.packet_detection=runtimeArgs.packet_detection
+    args.association=runtimeArgs.association
+    args.traveltime_file=runtimeArgs.traveltime_file
+    args.level_hold_time=runtimeArgs.level_hold_time
+    args.gap_grace=runtimeArgs.gap_grace
+    args.observatory=(30.5629, -90.7742)
     
     if args.verbose:
         loglevel = logging.DEBUG
@@ -39,31 +91,36 @@ def main():
             "Latitude":33.0399,
             "Longitude":-86.9978,
             "Channel":"US_LRAL:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
             },
         "MIAR":{
             "Latitude":34.5454,
             "Longitude":-93.5765,
             "Channel":"US_MIAR:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
             },
         "TEIG":{
             "Latitude":20.226,
             "Longitude":-88.276,
             "Channel":"IU_TEIG:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
         },
         "HKT":{
             "Latitude":29.965,
             "Longitude":-95.838,
             "Channel":"IU_HKT:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
         },
         "DWPF":{
             "Latitude":28.11,
             "Longitude":-81.433,
             "Channel":"IU_DWPF:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
         },
         
         # "735B":{
@@ -76,7 +133,8 @@ def main():
             "Latitude":27.546,
             "Longitude":-97.893,
             "Channel":"US_KVTX:00BHZ",
-            "PreferredServer":"cwbpub.cr.usgs.gov:18000"
+            "PreferredServer":"cwbpub.cr.usgs.gov:18000",
+            "Servers":["rtserve.iris.washington.edu:18000"]
         }
     }
 
@@ -84,6 +142,16 @@ def main():
     for station in pickets.keys():  
         pickets[station]['index']=str(ii)
         ii+=1
+    if runtimeArgs.seedlink_server is not None:
+        for station in pickets.keys():
+            pickets[station]['PreferredServer']=runtimeArgs.seedlink_server
+    if runtimeArgs.seedlink_server is not None or not runtimeArgs.redundant_servers:
+        for station in pickets.keys():
+            pickets[station].pop('Servers', None)
+        
+    if runtimeArgs.replay is not None:
+        picketFenceReplay(pickets, args, "L1:SEI-USGS_", runtimeArgs.replay, speed=runtimeArgs.speed).run()
+        return
         
     pf=PicketFence(picket_dict=pickets,myargs=args,epics_prefix="L1:SEI-USGS_")
     pf.run()
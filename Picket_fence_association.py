@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Association of the station triggers of the picket fence into earthquakes.
+
+An earthquake reaches the pickets one after the other. Wherever it is, two stations that trigger on it cannot trigger
+further apart in time than the wave takes to travel from one to the other: their distance over the slowest phase
+velocity. The associationEngine precomputes the distances between the pickets and from them to the observatory
+(haversine formula) and the P, S and surface wave travel times over them, and then, every time it is asked:
+-- confirms an event when at least 'min_stations' triggers are consistent with that moveout (within 'tolerance')
+-- marks a trigger as isolated when no other station triggered within the time the wave takes to reach its nearest
+   neighbour: a single-station glitch rather than an earthquake
+The detectionEngine shows the isolated stations as glitches, and clears the glitch flag of the stations of a
+confirmed event (a large earthquake) instead of waiting for them to quiet down over the whole displayed time. With a
+travelTimeGrid (Picket_fence_traveltime) every event is located from its triggers, and located again when more
+stations join it, which gives the arrival of its waves at the observatory.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+EARTH_RADIUS = 6371.0   # km
+
+#phase velocities (km/s) at regional distances: Pn, Sn and surface/Lg waves
+PHASE_VELOCITIES = {'P': 8.0, 'S': 4.5, 'surface': 3.5}
+
+#status of the trigger of a station
+NONE, PENDING, CONFIRMED, ISOLATED = 0, 1, 2, 3
+STATUS_NAMES = ('none', 'pending', 'confirmed', 'isolated')
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    #great circle distance in km between points in degrees, the arguments can be numpy arrays that broadcast
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class associationEngine():
+    """
+    Trigger times and status of every picket, as arrays in the order of self.names.
+
+    trigger() and clear() are called when a station leaves or comes back to gray, associate() decides which triggers
+    belong to an event. All of them can be called from any thread.
+    """
+    def __init__(self, picket_dict, observatory=None, min_stations=2, tolerance=5.0, velocities=PHASE_VELOCITIES, grid=None):
+        self.names = sorted(picket_dict.keys())
+        self.index = {name: ii for ii, name in enumerate(self.names)}
+        self.latitudes = np.array([float(picket_dict[name]['Latitude']) for name in self.names])
+        self.longitudes = np.array([float(picket_dict[name]['Longitude']) for name in self.names])
+        self.min_stations = min_stations
+        self.tolerance = tolerance                  # seconds allowed over the moveout, for the timing of the triggers
+        self.velocities = dict(velocities)
+
+        #distances (km) and travel times (s) between the pickets
+        self.distances = haversine(self.latitudes[:, None], self.longitudes[:, None], self.latitudes[None, :], self.longitudes[None, :])
+        self.moveouts = {phase: self.distances / velocity for phase, velocity in self.velocities.items()}
+        self.maxMoveout = self.distances / min(self.velocities.values())
+        #a trigger waits for another station as long as the wave takes to reach the nearest one
+        others = self.maxMoveout + np.diag(np.full(len(self.names), np.inf))
+        self.waitTime = (others.min(axis=1) if len(self.names) > 1 else np.full(1, np.inf)) + tolerance
+
+        #distances and travel times from the pickets to the observatory, (latitude, longitude)
+        self.observatory = observatory
+        self.observatoryDistances = None
+        self.observatoryTimes = dict()
+        if observatory is not None:
+            self.observatoryDistances = haversine(self.latitudes, self.longitudes, observatory[0], observatory[1])
+            self.observatoryTimes = {phase: self.observatoryDistances / velocity for phase, velocity in self.velocities.items()}
+
+        self.grid = grid                                    # travelTimeGrid that locates the events, None does not locate them
+        self.triggers = np.full(len(self.names), np.nan)    # POSIX time of the trigger of every picket, nan without one
+        self.status = np.zeros(len(self.names), dtype=np.int8)
+        self.event = None                                   # event whose stations are still triggered
+        self.events = []                                    # every confirmed event
+        self.lock = threading.Lock()
+
+    def trigger(self, station, time):
+        #only the first trigger counts until the station is cleared
+        ii = self.index.get(station)
+        if ii is None:
+            return
+        with self.lock:
+            if np.isnan(self.triggers[ii]):
+                self.triggers[ii] = time
+                self.status[ii] = PENDING
+
+    def clear(self, station):
+        ii = self.index.get(station)
+        if ii is None:
+            return
+        with self.lock:
+            self.triggers[ii] = np.nan
+            self.status[ii] = NONE
+            if self.event is not None and not np.any(self.status == CONFIRMED):
+                self.event = None
+
+    def consistentSet(self, active):
+        #largest set of triggers (greedy, in trigger order) that are pairwise within the moveout, starting from the
+        #stations already confirmed, or from the station consistent with the most others
+        times = self.triggers[active]
+        consistent = np.abs(times[:, None] - times[None, :]) <= self.maxMoveout[np.ix_(active, active)] + self.tolerance
+        members = list(np.flatnonzero(self.status[active] == CONFIRMED))
+        if not members:
+            members = [int(np.argmax(consistent.sum(axis=1)))]
+        for kk in np.argsort(times, kind='stable'):
+            if kk not in members and consistent[kk, members].all():
+                members.append(kk)
+        return active[members]
+
+    def associate(self, now):
+        """
+        Updates the status of the triggers at 'now' (POSIX time).
+        :return: (station -> status name of every triggered station, the event if it was confirmed now or else None)
+        """
+        with self.lock:
+            active = np.flatnonzero(~np.isnan(self.triggers))
+            confirmed = None
+            if len(active) >= self.min_stations:
+                members = self.consistentSet(active)
+                if len(members) >= self.min_stations:
+                    self.status[members] = CONFIRMED
+                    confirmed = members
+            waiting = ~np.isnan(self.triggers) & (self.status != CONFIRMED)
+            self.status[waiting] = np.where(now - self.triggers[waiting] < self.waitTime[waiting], PENDING, ISOLATED)
+
+            event = None
+            if confirmed is not None:
+                stations = [self.names[ii] for ii in confirmed[np.argsort(self.triggers[confirmed], kind='stable')]]
+                if self.event is None:
+                    event = self.newEvent(stations, now)
+                elif any(station not in self.event['triggers'] for station in stations):
+                    for station in stations:
+                        if station not in self.event['triggers']:
+                            self.event['stations'].append(station)
+                            self.event['triggers'][station] = float(self.triggers[self.index[station]])
+                    self.locate(self.event)
+            return {self.names[ii]: STATUS_NAMES[self.status[ii]] for ii in active}, event
+
+    def newEvent(self, stations, now):
+        first = self.index[stations[0]]
+        self.event = {'time': float(self.triggers[first]), 'stations': stations, 'confirmed': now,
+                      'delay': now - float(self.triggers[first]), 'location': None,
+                      'triggers': {station: float(self.triggers[self.index[station]]) for station in stations}}
+        self.locate(self.event)
+        self.events.append(self.event)
+        return self.event
+
+    def locate(self, event):
+        #epicenter, origin time and arrival at the observatory of the event from the triggers of its stations
+        if self.grid is None:
+            return
+        start = time.perf_counter()
+        event['location'] = self.grid.locate(event['stations'], [event['triggers'][station] for station in event['stations']])
+        event['locate_time'] = time.perf_counter() - start
+
+    def metrics(self):
+        with self.lock:
+            triggered = {self.names[ii]: {'time': float(self.triggers[ii]), 'status': STATUS_NAMES[self.status[ii]]}
+                         for ii in np.flatnonzero(~np.isnan(self.triggers))}
+            return {'triggers': triggered, 'events': [dict(event) for event in self.events[-10:]]}
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of the picket fence on synthetic data, without any connection or display.
+
+For every number of stations (6, 30 and 100 by default) and sampling rate (40 and 100 Hz) it measures
+-- ingest: SeedlinkUpdater.packetHandler on SeedLink packets (the miniSEED records of the emulator), in packets/s
+-- first_filter: filteredStream.filterNewData on the whole backfill, what a start or a new station costs
+-- filter and statistics: filteredStream.filterNewData and updateMetadata on every detection cycle. As with real
+   SeedLink arrivals, every station sends packets of its own length (1 to 5 update times, with a jitter of a few
+   samples) on its own schedule, so the stations get different amounts of new data on each cycle. filter_drift is the
+   median filter time of the last tenth of the cycles over the first tenth, and state_lag the largest time between the
+   end of the data of a channel and its saved filter state at the end: both stay small when the filter keeps up
+-- render_layout and render: blitRenderer.collect + render on an Agg canvas, the first refresh and the next ones
+-- render_full: SeedlinkPlotter.plot_lines (--render-mode full) on an Agg canvas
+-- publish: detectionEngine.publish into an EPICS writer, by default one that drops the values so only the cost of
+   building them is measured
+The times are in seconds per detection cycle or refresh (mean, median and max). The results are saved as JSON and can
+be compared with an earlier run, e.g.
+    python3 Picket_fence_benchmark.py --output baseline.json
+    python3 Picket_fence_benchmark.py --baseline baseline.json --output new.json
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from types import SimpleNamespace
+import platform
+import threading
+import logging
+import json
+import time
+import sys
+
+import numpy as np
+import obspy
+import scipy
+import matplotlib
+from obspy import Trace, UTCDateTime
+from obspy.clients.seedlink.slpacket import SLPacket
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from Picket_fence_code_v2 import ringBufferStream, filteredStream, detectionEngine, SeedlinkUpdater, SeedlinkPlotter, \
+    blitRenderer, picketFenceArguments, simulatedClock
+from Picket_fence_seedlink_emulator import syntheticSource, channelFeed
+from Picket_fence_epics import createWriter
+
+
+class nullWriter():
+    """
+    EPICS writer that drops the values.
+    """
+    def putMany(self, values):
+        pass
+
+    def close(self):
+        pass
+
+
+def timeStats(times):
+    times = np.array(times)
+    return {'mean': float(times.mean()), 'median': float(np.median(times)), 'max': float(times.max())}
+
+
+def stationNames(n_stations):
+    return ['S%03d' % ii for ii in range(n_stations)]
+
+
+def makeSources(n_stations, sampling_rate):
+    channel = 'HHZ' if sampling_rate >= 80 else 'BHZ'
+    return [(name, channel, syntheticSource('XX.%s..%s' % (name, channel), sampling_rate)) for name in stationNames(n_stations)]
+
+
+def makePackets(sources, starttime, duration, packet_length=1.0):
+    #SeedLink packets of 'duration' seconds of every source, in the order in which they would arrive
+    packets = []
+    for name, channel, source in sources:
+        feed = channelFeed(source, 'XX', name, '', channel, starttime, packet_length)
+        while feed.next < starttime + duration:
+            arrival = feed.next + feed.duration
+            sequence, records = feed.records()
+            packets += [(arrival, SLPacket(b"SL%06X" % ((sequence + ii) % 0x1000000) + record, 0)) for ii, record in enumerate(records)]
+    packets.sort(key=lambda packet: packet[0])
+    return [packet for arrival, packet in packets]
+
+
+def appendData(stream, sources, starttime, duration):
+    #adds 'duration' seconds of every source to the raw stream, as one trace per station
+    for name, channel, source in sources:
+        npts = int(round(duration * source.sampling_rate))
+        stream.appendTrace(Trace(data=source.read(starttime, npts), header={
+            'network': 'XX', 'station': name, 'location': '', 'channel': channel,
+            'sampling_rate': source.sampling_rate, 'starttime': starttime}))
+
+
+def stationFeeds(sources, start, update_time, rng):
+    #packet length (s) and end of the data already sent of every station, the first packets are staggered (what overlaps
+    #the backfill is dropped by the ring buffers)
+    feeds = []
+    for name, channel, source in sources:
+        packet = rng.uniform(1, 5) * update_time
+        feeds.append({'name': name, 'channel': channel, 'source': source, 'packet': packet, 'end': start - rng.uniform(0, packet)})
+    return feeds
+
+
+def appendPackets(stream, feeds, now, rng):
+    #adds the packets of every station that ended before 'now', of slightly different lengths
+    for feed in feeds:
+        source = feed['source']
+        while feed['end'] + feed['packet'] <= now:
+            npts = max(int(round(feed['packet'] * source.sampling_rate)) + int(rng.integers(-3, 4)), 1)
+            starttime = feed['end'] + 1.0 / source.sampling_rate
+            stream.appendTrace(Trace(data=source.read(starttime, npts), header={
+                'network': 'XX', 'station': feed['name'], 'location': '', 'channel': feed['channel'],
+                'sampling_rate': source.sampling_rate, 'starttime': starttime}))
+            feed['end'] = starttime + (npts - 1) / source.sampling_rate
+
+
+def stateLag(filtStream):
+    #largest time between the end of the raw data of a channel and its saved filter state
+    lags = [filtStream.rawStream.buffers[trace_id].endtime - values['stateEndtime']
+            for trace_id, values in filtStream.customMetadata.items() if 'stateEndtime' in values]
+    return max(lags) if lags else 0.0
+
+
+def benchmarkIngest(sources, args, start, duration=60):
+    packets = makePackets(sources, start, duration)
+    updater = SeedlinkUpdater(ringBufferStream(buffer_time=args.stream_time), myargs=args, lock=threading.Lock())
+    begin = time.perf_counter()
+    for count, packet in enumerate(packets):
+        updater.packetHandler(count, packet)
+    return {'packets': len(packets), 'packets_per_s': len(packets) / (time.perf_counter() - begin)}
+
+
+def aggFigure(args):
+    #a figure of the size of the display, drawn by Agg instead of Tk
+    figure = Figure(figsize=(args.x_size / 100.0, args.y_size / 100.0), dpi=100)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def renderBlit(renderer, filtStream, levels, args):
+    stop = filtStream.clock.now()
+    begin = time.perf_counter()
+    renderer.render(renderer.collect(filtStream, stop - args.backtrace_time, stop), levels, stop)
+    return time.perf_counter() - begin
+
+
+def renderFull(filtStream, levels, args, refreshes):
+    #plot_lines only needs the figure and the parameters of the plotter
+    stop = filtStream.clock.now()
+    plotter = SimpleNamespace(figure=aggFigure(args), args=args, threshold=args.threshold,
+                              start_time=stop - args.backtrace_time, stop_time=stop)
+    times = []
+    for ii in range(refreshes):
+        begin = time.perf_counter()
+        stream = filtStream.sliceStream(starttime=plotter.start_time)
+        stream.trim(starttime=plotter.start_time, endtime=plotter.stop_time)
+        SeedlinkPlotter.plot_lines(plotter, stream, levels)
+        times.append(time.perf_counter() - begin)
+    return timeStats(times)
+
+
+def benchmarkCase(n_stations, sampling_rate, cycles=20, epics_backend=None, render=True):
+    args = picketFenceArguments()
+    args.epics_prefix = 'BENCH:'
+    sources = makeSources(n_stations, sampling_rate)
+    start = UTCDateTime(2024, 1, 1)
+    result = {'stations': n_stations, 'sampling_rate': sampling_rate, 'cycles': cycles}
+
+    result.update(benchmarkIngest(sources, args, start))
+
+    #the backfill of a start, then one detection cycle after the other
+    clock = simulatedClock(start, speed=0)
+    stream = ringBufferStream(buffer_time=args.stream_time)
+    filtStream = filteredStream(stream, myargs=args, clock=clock)
+    backfill = filtStream.startupTime + args.backtrace_time
+    appendData(stream, sources, start, backfill)
+    now = start + backfill
+    rng = np.random.default_rng(n_stations)
+    feeds = stationFeeds(sources, now - 1.0 / sampling_rate, args.update_time, rng)
+    clock.set(now)
+    begin = time.perf_counter()
+    filtStream.filterNewData()
+    filtStream.updateMetadata(now)
+    result['first_filter'] = time.perf_counter() - begin
+
+    pickets = {name: {'index': str(ii + 1), 'Latitude': 0.0, 'Longitude': 0.0} for ii, name in enumerate(stationNames(n_stations))}
+    writer = nullWriter() if epics_backend is None else createWriter(epics_backend, prefix=args.epics_prefix, picket_dict=pickets)
+    engine = detectionEngine(filtStream, picket_dict=pickets, myargs=args, lock=threading.Lock(), writer=writer, clock=clock)
+    metadata = {trace_id: dict(values) for trace_id, values in filtStream.customMetadata.items() if values.get('ACTIVE')}
+    trace_ids = sorted(metadata.keys())
+    levels = engine.classify(trace_ids, metadata)
+    if render:
+        renderer = blitRenderer(aggFigure(args), args)
+        result['render_layout'] = renderBlit(renderer, filtStream, levels, args)
+
+    filterTimes, statisticsTimes, renderTimes = [], [], []
+    for ii in range(cycles):
+        now += args.update_time
+        appendPackets(stream, feeds, now, rng)
+        clock.set(now)
+        begin = time.perf_counter()
+        filtStream.filterNewData()
+        filterTimes.append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        filtStream.updateMetadata(now)
+        statisticsTimes.append(time.perf_counter() - begin)
+        if render:
+            renderTimes.append(renderBlit(renderer, filtStream, levels, args))
+    result['filter'] = timeStats(filterTimes)
+    tenth = max(cycles // 10, 1)
+    result['filter_drift'] = float(np.median(filterTimes[-tenth:]) / np.median(filterTimes[:tenth]))
+    result['state_lag'] = stateLag(filtStream)
+    result['statistics'] = timeStats(statisticsTimes)
+    if render:
+        result['render'] = timeStats(renderTimes)
+        result['render_full'] = renderFull(filtStream, levels, args, max(cycles // 5, 1))
+
+    try:
+        times = []
+        for ii in range(cycles):
+            begin = time.perf_counter()
+            engine.publish(trace_ids, metadata, levels)
+            times.append(time.perf_counter() - begin)
+        result['publish'] = timeStats(times)
+    except Exception as e:
+        result['publish'] = {'error': str(e)}
+    writer.close()
+    return result
+
+
+def compare(results, baseline):
+    #ratio of every time to the one of the same case in the baseline (above 1 is slower), packets/s the other way round
+    cases = {(case['stations'], case['sampling_rate']): case for case in baseline['results']}
+    for case in results:
+        old = cases.get((case['stations'], case['sampling_rate']))
+        if old is None:
+            continue
+        ratios = []
+        for key, value in case.items():
+            if key not in old or key in ('stations', 'sampling_rate', 'cycles', 'packets', 'filter_drift', 'state_lag'):
+                continue
+            if isinstance(value, dict) and 'median' in value and 'median' in old[key]:
+                ratios.append("%s %.2fx" % (key, value['median'] / old[key]['median']))
+            elif key == 'packets_per_s':
+                ratios.append("ingest %.2fx" % (old[key] / value))
+            elif isinstance(value, float):
+                ratios.append("%s %.2fx" % (key, value / old[key]))
+        print("%3d stations %3d Hz vs baseline: %s" % (case['stations'], case['sampling_rate'], ", ".join(ratios)))
+
+
+def main():
+    parser = ArgumentParser(prog='Picket_fence_benchmark',
+                            description='Measure the hot paths of the picket fence on synthetic data',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--stations', default=[6, 30, 100], type=int, nargs='+', help='numbers of stations')
+    parser.add_argument('--rates', default=[40, 100], type=float, nargs='+', help='sampling rates in Hz')
+    parser.add_argument('--cycles', default=100, type=int, help='detection cycles and refreshes measured in every case')
+    parser.add_argument('--epics-backend', default=None, choices=['pyepics', 'caput', 'pcaspy'],
+                        help='measure the publish with this EPICS writer instead of one that drops the values')
+    parser.add_argument('--no-render', default=False, action='store_true', help='skip the display benchmarks')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = []
+    for n_stations in args.stations:
+        for sampling_rate in args.rates:
+            result = benchmarkCase(n_stations, sampling_rate, cycles=args.cycles, epics_backend=args.epics_backend,
+                                   render=not args.no_render)
+            results.append(result)
+            print(json.dumps(result))
+
+    report = {'time': str(UTCDateTime()), 'python': sys.version.split()[0], 'platform': platform.platform(),
+              'numpy': np.__version__, 'scipy': scipy.__version__, 'obspy': obspy.__version__,
+              'matplotlib': matplotlib.__version__, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
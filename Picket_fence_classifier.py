@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Station levels of the picket fence.
+
+A stationClassifier keeps the state of every station in arrays (potential glitch flag, level held by the hysteresis
+and until when) and updates all of them in one vectorized step from the statistics of the filtered data: the MAX over
+the last 'lookback' seconds and the Glitch_ABSMAX over the displayed time.
+-- MAX above the glitch level (50000): potential glitch
+-- otherwise above 10x, 2x or 1x the threshold: red, orange or yellow, and gray below
+-- a potential glitch is cleared when the station is back to yellow with its displayed data under 2x the threshold,
+   or back to gray with it under 200
+-- a single potential glitch is reported (NETWORK_AUX1); several at the same time are probably a large earthquake,
+   they are all cleared and -1 is reported
+With a hold time, the level of an earthquake is kept for that many seconds after the station last reached it, so a
+station does not flicker between two levels.
+
+It does not depend on Tk, the SeedLink client or EPICS, so it can be run (and tested) alone, e.g.
+    classifier = stationClassifier(['HLID', 'OTR'], threshold=500)
+    codes, aux = classifier.update(['HLID', 'OTR'], [700.0, 60000.0], [700.0, 60000.0])
+    classifier.levelDict(['HLID', 'OTR'], codes)   # {'HLID': 'yellow', 'OTR': 'glitch'}, aux is 'OTR'
+The detectionEngine uses its levels for the display and for EPICS.
+"""
+
+import numpy as np
+
+GRAY, YELLOW, ORANGE, RED, GLITCH = 0, 1, 2, 3, 4
+LEVEL_NAMES = ('gray', 'yellow', 'orange', 'red', 'glitch')
+
+#background color that the display uses for each level
+LEVEL_COLORS = {'glitch': "#00FFFF", 'red': "#FF2929", 'orange': "orange", 'yellow': "yellow", 'gray': "#D3D3D3"}
+
+
+class stationClassifier():
+    """
+    Level of every station, in the order of self.names. Stations that are not known yet are added when they are
+    first seen.
+    """
+    def __init__(self, names=(), threshold=500, glitch_level=50000, glitch_clear=200, hold_time=0):
+        self.threshold = threshold          # nm/s of yellow, orange is 2x and red 10x
+        self.glitch_level = glitch_level    # MAX over which a station is a potential glitch
+        self.glitch_clear = glitch_clear    # Glitch_ABSMAX under which a gray station is no longer a potential glitch
+        self.hold_time = hold_time          # seconds a level is kept after it was last reached, 0 follows the data
+        self.names = []
+        self.index = dict()
+        self.glitch = np.zeros(0, dtype=bool)       # potential glitch flag
+        self.held = np.zeros(0, dtype=np.int8)      # earthquake level kept by the hysteresis
+        self.heldUntil = np.zeros(0)                # time until which it is kept
+        self.add(names)
+
+    def add(self, names):
+        new = [name for name in dict.fromkeys(names) if name not in self.index]
+        if not new:
+            return
+        for name in new:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        self.glitch = np.concatenate([self.glitch, np.zeros(len(new), dtype=bool)])
+        self.held = np.concatenate([self.held, np.zeros(len(new), dtype=np.int8)])
+        self.heldUntil = np.concatenate([self.heldUntil, np.zeros(len(new))])
+
+    def columns(self, names):
+        self.add(names)
+        return np.array([self.index[name] for name in names], dtype=np.intp)
+
+    def levelOf(self, values):
+        #level of peak values: GLITCH above the glitch level, otherwise by the threshold
+        values = np.asarray(values, dtype=np.float64)
+        threshold = self.threshold
+        return np.select([values > self.glitch_level, values > 10 * threshold, values > 2 * threshold, values > threshold],
+                         [GLITCH, RED, ORANGE, YELLOW], GRAY).astype(np.int8)
+
+    def update(self, names, max_values, glitch_absmax, now=0.0):
+        """
+        One classification of the stations 'names', with their MAX (nan without data in the lookback window) and
+        Glitch_ABSMAX, at 'now' (seconds, only used by the hysteresis).
+        :return: (level code of every station of 'names', value for NETWORK_AUX1: the name of the only potential
+                  glitch, -1 if several were cleared, None otherwise)
+        """
+        columns = self.columns(names)
+        maxValues = np.full(len(self.names), np.nan)
+        maxValues[columns] = max_values
+        absmax = np.full(len(self.names), np.nan)
+        absmax[columns] = glitch_absmax
+        hasData = ~np.isnan(maxValues)
+        threshold = self.threshold
+
+        levels = np.where(hasData, self.levelOf(maxValues), GRAY)
+        self.glitch |= levels == GLITCH
+        self.glitch &= ~(((levels == YELLOW) & (absmax < 2 * threshold)) | ((levels == GRAY) & hasData & (absmax < self.glitch_clear)))
+
+        aux = None
+        glitching = np.flatnonzero(self.glitch)
+        if len(glitching) == 1:
+            aux = self.names[glitching[0]]
+        elif len(glitching) > 1:  ## if multiple "glitches", they are probably not glitching (very large EQ??)
+            aux = -1
+            self.glitch[:] = False
+
+        #a cleared glitch is gray until its MAX is under the glitch level
+        levels[levels == GLITCH] = GRAY
+        if self.hold_time > 0:
+            reached = levels >= self.held
+            self.heldUntil[reached] = now + self.hold_time
+            self.held = np.where(reached | (now >= self.heldUntil), levels, self.held).astype(np.int8)
+            self.held[self.glitch] = GRAY
+            levels = self.held.copy()
+        levels[self.glitch] = GLITCH
+        return levels[columns], aux
+
+    def glitchNames(self):
+        return [self.names[ii] for ii in np.flatnonzero(self.glitch)]
+
+    def clearGlitches(self, names):
+        self.glitch[self.columns(names)] = False
+
+    def levelDict(self, names, codes):
+        return {name: LEVEL_NAMES[code] for name, code in zip(names, codes)}
@@ -25,8 +25,21 @@ Created on Wed Aug 30 11:36:15 2023
 #-- filteredStream:
     # This class is a subclass of ObsPy's stream: https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html
     # The objective of the class is to handle all of the data processing of the raw stream that is collected by an instance of the seedlinkUpdater
+#-- detectionEngine:
+    # Runs the detection loop on its own thread: it filters the data through the filteredStream, classifies the stations and writes
+    # the EPICS variables. The seedlinkPlotter only displays its results, so the picket fence can also run without a display (headless).
+#-- blitRenderer:
+    # Persistent-artist drawing of the stations for the seedlinkPlotter: the axes are built once per station set and window size,
+    # afterwards only the traces and the time stamp are redrawn on top of a saved background (blitting).
+    # The traces are drawn as min/max envelopes with one column per pixel (envelopeDecimator), updated with the new samples only.
+#-- realClock/simulatedClock:
+    # The time source of the picket fence. PicketFence passes its clock to the engine, the filteredStream and the display, and each
+    # cycle reads it once, so replays can run the whole pipeline on a simulated time.
+#-- ringBufferStream:
+    # The raw stream shared by the seedlinkUpdaters. It keeps one fixed-size circular buffer per trace id (traceRingBuffer) so that
+    # adding a packet does not require merging and trimming the whole stream. Reading its traces gives a normal ObsPy Stream view.
 
-#[ELB] 08/30/2023    
+#[ELB] 08/30/2023
 
 
 ### IMPORTS ###
@@ -47,7 +60,7 @@ except ImportError:
     import Tkinter as tkinter
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
-from matplotlib.ticker import MaxNLocator
+from matplotlib.ticker import MaxNLocator, MultipleLocator
 from matplotlib.patheffects import withStroke
 from matplotlib.dates import date2num
 import matplotlib.pyplot as plt
@@ -59,17 +72,23 @@ from obspy.core.util import MATPLOTLIB_VERSION
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
 import threading
+import signal as signal_module  ## scipy.signal is imported as signal
 import os
-from time import sleep
+from collections import deque
+from time import sleep, perf_counter
 from datetime import datetime
 from gwpy.time import tconvert
-import subprocess
 import sys
-from scipy import signal
+from scipy import signal, linalg
 
 import logging
 import numpy as np
 
+from Picket_fence_epics import createWriter, stationPrefix
+from Picket_fence_metrics import latencyMonitor, metricsServer, stageTimer, rollingStats
+from Picket_fence_association import associationEngine
+from Picket_fence_traveltime import travelTimeGrid
+from Picket_fence_classifier import stationClassifier, LEVEL_NAMES, LEVEL_COLORS, GRAY, RED, GLITCH
 
 OBSPY_VERSION = [int(x) for x in OBSPY_VERSION.split(".")[:2]]
 # check obspy version and warn if it's below 0.10.0, which means that a memory
@@ -130,14 +149,345 @@ except AttributeError:
     # add the function in the class
     setattr(SLPacket, 'get_trace', get_trace)
 
+class realClock():
+    """
+    Wall clock of the picket fence. Every part that needs the current time asks the clock given to PicketFence,
+    so the same code runs on a simulatedClock for replays and tests.
+    """
+    def now(self):
+        return UTCDateTime()
+
+class simulatedClock():
+    """
+    Clock that starts at 'start' and runs 'speed' times faster than the wall clock. With speed 0 it only moves with set(),
+    which lets a replay step it exactly.
+    """
+    def __init__(self, start, speed=1.0):
+        self.speed=speed
+        self.set(start)
+
+    def set(self, time):
+        self.start=time
+        self.wallStart=perf_counter()
+
+    def now(self):
+        if self.speed==0:
+            return self.start
+        return self.start+(perf_counter()-self.wallStart)*self.speed
+
+class traceRingBuffer():
+    """
+    Fixed-capacity circular buffer that keeps the most recent samples of a single channel.
+
+    Appending a packet costs O(packet) regardless of how much data is buffered. Samples are stored on a
+    regular time grid anchored to the first packet received, gaps between packets are filled by linear
+    interpolation (the same as Stream.merge(1, fill_value='interpolate')) and recorded in self.gaps.
+    """
+    def __init__(self, stats, capacity):
+        self.network=stats.network
+        self.station=stats.station
+        self.location=stats.location
+        self.channel=stats.channel
+        self.id=stats.get_id() if hasattr(stats,'get_id') else ".".join((stats.network, stats.station, stats.location, stats.channel))
+        self.sampling_rate=stats.sampling_rate
+        self.delta=stats.delta
+        self.capacity=int(capacity)
+
+        self.data=np.zeros(self.capacity, dtype=np.float64)
+        self.head=0             # index of the buffer where the next sample will be written
+        self.count=0            # number of valid samples in the buffer
+        self.endtime=None       # time of the newest sample in the buffer
+        self.gaps=[]            # list of [starttime, endtime] of the samples that were interpolated
+        self.gapCount=0         # gaps interpolated since the buffer was created
+
+    @property
+    def starttime(self):
+        if self.endtime is None:
+            return None
+        return self.endtime-(self.count-1)*self.delta
+
+    def _write(self, data):
+        n=len(data)
+        if n>=self.capacity: #only the newest samples fit
+            self.data[:]=data[-self.capacity:]
+            self.head=0
+            self.count=self.capacity
+            return
+        first=min(n, self.capacity-self.head)
+        self.data[self.head:self.head+first]=data[:first]
+        self.data[:n-first]=data[first:]
+        self.head=(self.head+n)%self.capacity
+        self.count=min(self.count+n, self.capacity)
+
+    def opensGap(self, starttime):
+        #True when a packet that starts at 'starttime' leaves samples missing after the end of the buffer
+        return self.endtime is not None and starttime-self.endtime>1.5*self.delta
+
+    def reset(self):
+        self.head=0
+        self.count=0
+        self.endtime=None
+        self.gaps=[]
+
+    def append(self, data, starttime):
+        """
+        Add the samples of a packet that starts at 'starttime'.
+
+        Samples that are already in the buffer (overlaps, repeated packets) are discarded and the gap
+        between the buffer and the packet, if any, is interpolated.
+        :return: number of new samples that were written (0 for a late or repeated packet).
+        """
+        data=np.asarray(data, dtype=np.float64)
+        if len(data)==0:
+            return 0
+        if self.endtime is None:
+            self._write(data)
+            self.endtime=starttime+(len(data)-1)*self.delta
+            return len(data)
+
+        # number of samples missing between the end of the buffer and the start of the packet
+        missing=int(round((starttime-self.endtime)*self.sampling_rate))-1
+        if missing<0: #overlap, keep only the samples that we have not seen yet
+            data=data[-missing:]
+            if len(data)==0:
+                return 0
+            missing=0
+        elif missing>=self.capacity: #the gap is longer than the buffer, start over
+            gapStart=self.endtime+self.delta
+            self.reset()
+            self._write(data)
+            self.endtime=starttime+(len(data)-1)*self.delta
+            self.gaps.append([gapStart, starttime-self.delta])
+            self.gapCount+=1
+            return len(data)
+        elif missing>0: #interpolate the gap
+            lastValue=self.data[self.head-1]
+            self._write(np.linspace(lastValue, data[0], missing+2)[1:-1])
+            self.gaps.append([self.endtime+self.delta, self.endtime+missing*self.delta])
+            self.gapCount+=1
+
+        self._write(data)
+        self.endtime=self.endtime+(missing+len(data))*self.delta
+
+        #forget the gaps that are no longer in the buffer
+        while self.gaps and self.gaps[0][1]<self.starttime:
+            self.gaps.pop(0)
+        return len(data)
+
+    def getData(self, starttime=None):
+        """
+        Return a contiguous copy of the buffered samples from 'starttime' (nearest sample) until the end.
+        """
+        if self.count==0:
+            return np.empty(0, dtype=np.float64)
+        n=self.count
+        if starttime is not None:
+            skip=int(round((starttime-self.starttime)*self.sampling_rate))
+            n=min(max(self.count-skip, 0), self.count)
+        if n==0:
+            return np.empty(0, dtype=np.float64)
+        start=(self.head-n)%self.capacity
+        if start+n<=self.capacity:
+            return self.data[start:start+n].copy()
+        return np.concatenate((self.data[start:], self.data[:self.head]))
+
+    def toTrace(self, starttime=None):
+        data=self.getData(starttime)
+        header={'network':self.network, 'station':self.station, 'location':self.location,
+                'channel':self.channel, 'sampling_rate':self.sampling_rate,
+                'starttime':self.endtime-(len(data)-1)*self.delta if self.endtime is not None else UTCDateTime(0)}
+        return Trace(data=data, header=header)
+
+class ringBufferStream(Stream):
+    """
+    Stream made of one traceRingBuffer per trace id, each one holding 'buffer_time' seconds of data.
+
+    Reading self.traces builds new Trace objects from the buffers, so the stream can be used as a
+    read-only view by anything that expects an ObsPy Stream. Only append(), extend() and += write data.
+
+    A channel that is downloaded from several servers can be given a grace time in self.gapHold: a packet that would
+    leave a gap in its buffer is held instead, so that the copy of the missing packets from another server is written
+    first. Held packets are written as soon as they follow the buffered samples, or with the gap interpolated once the
+    first of them was held for the grace time (releaseHeld).
+    """
+    def __init__(self, traces=None, buffer_time=3600, clock=None):
+        self.buffer_time=buffer_time
+        self.buffers=dict()
+        self.clock=realClock() if clock is None else clock
+        self.gapHold=dict()     # trace id -> seconds a packet that leaves a gap waits for the missing samples
+        self.held=dict()        # trace id -> list of (time it was held, trace) of the held packets, in time order
+        super(ringBufferStream, self).__init__()
+        if isinstance(traces, Trace):
+            traces=[traces]
+        if traces:
+            self.extend(traces)
+
+    @property
+    def traces(self):
+        return [self.buffers[trace_id].toTrace() for trace_id in sorted(self.buffers.keys())]
+
+    @traces.setter
+    def traces(self, traces):
+        self.buffers=dict()
+        self.held=dict()
+        self.extend(traces)
+
+    def appendTrace(self, trace):
+        """
+        Add the data of a trace (normally a single SeedLink record) to the buffer of its id.
+        :return: number of new samples that were written, or held until the samples before them arrive.
+        """
+        buffer=self.buffers.get(trace.id)
+        if buffer is None or buffer.sampling_rate!=trace.stats.sampling_rate:
+            buffer=traceRingBuffer(trace.stats, capacity=int(np.ceil(self.buffer_time*trace.stats.sampling_rate))+1)
+            self.buffers[trace.id]=buffer
+        if self.gapHold.get(trace.id, 0)>0 and buffer.opensGap(trace.stats.starttime):
+            return self.hold(trace)
+        written=buffer.append(trace.data, trace.stats.starttime)
+        if trace.id in self.held:
+            self.releaseHeld(trace_ids=[trace.id])
+        return written
+
+    def hold(self, trace):
+        #keeps a packet that would leave a gap, the copy of a packet that is already held is discarded
+        held=self.held.setdefault(trace.id, [])
+        if any(other.stats.starttime==trace.stats.starttime for since, other in held):
+            return 0
+        held.append((self.clock.now(), trace))
+        held.sort(key=lambda item: item[1].stats.starttime)
+        return len(trace.data)
+
+    def releaseHeld(self, now=None, trace_ids=None):
+        """
+        Writes the held packets that no longer leave a gap and, with 'now', all the packets of a channel whose first
+        packet was held for its whole grace time, interpolating the gaps.
+        """
+        for trace_id in list(self.held.keys()) if trace_ids is None else trace_ids:
+            held=self.held.get(trace_id)
+            if not held:
+                continue
+            buffer=self.buffers[trace_id]
+            expired=now is not None and now-min(since for since, trace in held)>=self.gapHold.get(trace_id, 0)
+            while held and (expired or not buffer.opensGap(held[0][1].stats.starttime)):
+                since, trace=held.pop(0)
+                buffer.append(trace.data, trace.stats.starttime)
+            if not held:
+                del self.held[trace_id]
+
+    def append(self, trace):
+        self.appendTrace(trace)
+        return self
+
+    def extend(self, trace_list):
+        if isinstance(trace_list, Stream):
+            trace_list=trace_list.traces
+        for trace in trace_list:
+            self.appendTrace(trace)
+        return self
+
+    def copy(self):
+        #a plain Stream with copies of the buffered data
+        return Stream(traces=self.traces)
+
+    def getTraceIDs(self):
+        return sorted(self.buffers.keys())
+
+    def checkpointArrays(self, prefix):
+        #the buffered data as arrays for np.savez, keyed by prefix+trace id
+        arrays=dict()
+        for trace_id, buffer in self.buffers.items():
+            if buffer.endtime is None:
+                continue
+            arrays[prefix+trace_id+"/data"]=buffer.getData()
+            arrays[prefix+trace_id+"/info"]=np.array([buffer.sampling_rate, buffer.endtime.timestamp])
+        return arrays
+
+    def restoreArrays(self, arrays, prefix):
+        #adds the data saved by checkpointArrays() to the buffers, returns the restored trace ids
+        restored=[]
+        for key in arrays.keys():
+            if not (key.startswith(prefix) and key.endswith("/data")):
+                continue
+            trace_id=key[len(prefix):-len("/data")]
+            data=arrays[key]
+            sampling_rate, endtime=arrays[prefix+trace_id+"/info"]
+            network, station, location, channel=trace_id.split('.')
+            header={'network':network, 'station':station, 'location':location, 'channel':channel,
+                    'sampling_rate':sampling_rate, 'starttime':UTCDateTime(endtime)-(len(data)-1)/sampling_rate}
+            self.appendTrace(Trace(data=data, header=header))
+            restored.append(trace_id)
+        return restored
+
+    def getEndtime(self, trace_id):
+        return self.buffers[trace_id].endtime
+
+    def sliceTrace(self, trace_id, starttime=None):
+        #returns a Trace with only the data after 'starttime', the cost is proportional to the returned data
+        return self.buffers[trace_id].toTrace(starttime)
+
+    def getGapList(self):
+        #similar to Stream.get_gaps(), the gaps here were already interpolated in the buffers
+        return [[trace_id, gap[0], gap[1]] for trace_id in self.getTraceIDs() for gap in self.buffers[trace_id].gaps]
+
+class feedStatistics():
+    """
+    Latency of the packets received from one server, and how many of them arrived before the copy of another server.
+
+    The latency of a packet is the time between its last sample and its arrival, it is only kept for the packets that
+    were recorded after the connection was opened (the backfill says nothing about the feed). When a station is
+    downloaded from several servers the first copy of each packet is written to the buffers and the others are
+    discarded, so 'first' counts the packets that this server delivered first. A packet that would leave a gap is
+    held for 'gap_grace' seconds, so the missing packets can still come from another server.
+    """
+    def __init__(self, server_name, clock=None, length=1000):
+        self.server_name=server_name
+        self.clock=realClock() if clock is None else clock
+        self.packets=0                          # packets received
+        self.first=0                            # packets that had new samples
+        self.latencies=deque(maxlen=length)     # latencies (in seconds) of the last packets
+        self.since=None                         # time when the current connection was opened
+
+    def connected(self):
+        self.since=self.clock.now()
+
+    def isLive(self, trace):
+        #False for the packets of the backfill
+        return self.since is None or trace.stats.endtime>=self.since
+
+    def record(self, trace, written):
+        self.packets+=1
+        if written>0:
+            self.first+=1
+        if self.isLive(trace):
+            self.latencies.append(self.clock.now()-trace.stats.endtime)
+
+    def metrics(self):
+        metrics={'packets':self.packets, 'first':self.first, 'latency_p50':None, 'latency_p95':None}
+        if self.latencies:
+            latencies=np.array(self.latencies)
+            metrics.update({'latency_p50':float(np.median(latencies)), 'latency_p95':float(np.percentile(latencies, 95))})
+        return metrics
+
+    def summary(self):
+        if self.packets==0:
+            return "%s: no packets" % self.server_name
+        summary="%s: %d packets, %.0f%% first" % (self.server_name, self.packets, 100.0*self.first/self.packets)
+        if not self.latencies:
+            return summary+", no live packets yet"
+        latencies=np.array(self.latencies)
+        return summary+", latency %.1f s median, %.1f s 95%%" % (np.median(latencies), np.percentile(latencies, 95))
+
 class SeedlinkUpdater(SLClient):
     
-    def __init__(self, stream, myargs=None, lock=None):
+    def __init__(self, stream, myargs=None, lock=None, statistics=None, monitor=None, detector=None):
         # loglevel NOTSET delegates messages to parent logger
         super(SeedlinkUpdater, self).__init__(loglevel="NOTSET")
         self.stream = stream
         self.lock = lock
         self.args = myargs
+        self.statistics = statistics  # feedStatistics of the server
+        self.monitor = monitor  # latencyMonitor of the stations
+        self.detector = detector  # packetDetector that checks every packet at once, None leaves it to the detection cycle
         self.stop_flag=False
 
     def run(self, packet_handler=None):
@@ -222,15 +572,29 @@ class SeedlinkUpdater(SLClient):
                 self.__class__.__name__ + ": blockette contains no trace")
             return False
 
-        # new samples add to the main stream which is then trimmed
-        with self.lock:
-            self.stream += trace
-            self.stream.merge(1,fill_value='interpolate')
-            self.stream.trim(starttime=UTCDateTime()-3600)
-            for trace in self.stream:
-                trace.stats.processing = []
+        self.handleTrace(trace)
         return False
 
+    def handleTrace(self, trace):
+        """
+        Adds the trace of a packet to the raw stream, it is also used to replay archived data without a connection.
+        :return: number of new samples, 0 when another server already delivered the packet.
+        """
+        arrival = perf_counter()
+        # new samples are written into the ring buffer of their channel, the oldest ones are overwritten and the samples
+        # that are already there (the copy of the same packet from another server) are discarded. A packet after a gap
+        # can be held for a while, see ringBufferStream
+        with self.lock:
+            written = self.stream.appendTrace(trace)
+            gaps = self.stream.buffers[trace.id].gapCount
+        if self.statistics is not None:
+            self.statistics.record(trace, written)
+        if self.monitor is not None:
+            self.monitor.record(trace, written, live=self.statistics is None or self.statistics.isLive(trace), gaps=gaps)
+        if self.detector is not None and written > 0:
+            self.detector.onPacket(trace.id, arrival)
+        return written
+
     def getTraceIDs(self):
         """
         Return a list of SEED style Trace IDs that the SLClient is trying to
@@ -253,7 +617,11 @@ class SeedlinkUpdater(SLClient):
         return ids
 class picketFenceArguments():
     def __init__(self, stream_time=3600, backtrace_time=15*60, x_position=0, y_position=0, x_size=800, y_size=600, title_size=10, time_legend_size=10,
-    tick_format='%H:%M:%S',time_tick_nb=5,threshold=500,lookback=120,update_time=2,fullscreen=False,verbose=False,send_epics=False,epics_prefix=None):
+    tick_format='%H:%M:%S',time_tick_nb=5,threshold=500,lookback=120,update_time=2,fullscreen=False,verbose=False,send_epics=False,epics_prefix=None,
+    filter_engine='sos',headless=False,epics_backend='auto',render_mode='blit',checkpoint_file=None,checkpoint_interval=60,
+    statefile_prefix=None,feed_report_interval=600,latency_interval=60,metrics_port=None,filter_init='taper',settle_time=10,preroll_time=5,packet_detection=False,
+    association=False,association_stations=2,association_tolerance=5.0,observatory=None,
+    traveltime_file=None,level_hold_time=0,gap_grace=20):
     
         #Plot format properties
         self.x_position=x_position              # horizontal position of the graph
@@ -265,6 +633,7 @@ class picketFenceArguments():
         self.tick_format=tick_format            # time format for the time ticks
         self.time_tick_nb=time_tick_nb          # number of time ticks
         self.fullscreen=fullscreen              # True toggles the fullscreen display
+        self.render_mode=render_mode            # 'blit' keeps the axes and only redraws the traces, 'full' rebuilds the whole figure with Stream.plot
 
         #Data display properties
         self.backtrace_time=backtrace_time      # time (in seconds) that will be displayed in plots
@@ -273,36 +642,156 @@ class picketFenceArguments():
         self.stream_time=stream_time            # time in seconds that will be kept of the stream before deleting
         self.threshold=threshold                # threshold in (nm/s) for determining the triggers for color changes    
         self.lookback=lookback                  # time (in seconds) that we analyze in search of earthquake signals
+        self.level_hold_time=level_hold_time    # time (in seconds) a station keeps its level after it last reached it, 0 follows the data
         self.update_time=update_time            # refresh rate (in seconds) of the graph
+        self.packet_detection=packet_detection  # True also checks every packet against the thresholds as soon as it arrives (packetDetector)
+        self.association=association            # True confirms the triggers of several stations with their moveout (associationEngine)
+        self.association_stations=association_stations # number of stations whose triggers confirm an event
+        self.association_tolerance=association_tolerance # time (in seconds) allowed over the travel time between two stations
+        self.observatory=observatory            # (latitude, longitude) of the observatory, None if unknown
+        self.traveltime_file=traveltime_file    # prefix of the files of the travel-time grid of the observatory, None computes it at every start
+        self.filter_engine=filter_engine        # 'sos' runs the discretized filter with sosfilt, 'lsim' keeps the original continuous-time simulation
+        self.filter_init=filter_init            # 'taper' starts the filter of a new channel at rest on tapered data, 'steady' in the steady state of its first samples
+        self.settle_time=settle_time            # time (in seconds) of filtered data discarded at the start of a channel with filter_init='steady'
+        self.preroll_time=preroll_time          # time (in seconds) of the first samples whose mean is the level of the steady state
+        self.checkpoint_file=checkpoint_file    # file where the buffers and filter states are saved to survive a restart, None keeps them only in memory
+        self.checkpoint_interval=checkpoint_interval # time (in seconds) between checkpoints
+        self.statefile_prefix=statefile_prefix  # prefix of the SeedLink state files (sequence numbers, one per server), None keeps them only in memory
+        self.feed_report_interval=feed_report_interval # time (in seconds) between the reports of the latency of each server, 0 disables them
+        self.gap_grace=gap_grace                # time (in seconds) a packet after a gap waits for the other servers of its picket to send the missing data
+        self.latency_interval=latency_interval  # time (in seconds) between the updates of the latency of each station (printed and in EPICS), 0 disables them
+        self.metrics_port=metrics_port          # port of the JSON metrics on localhost, None does not serve them
     
         #other arguments
         self.verbose=verbose                    # True toggles the debug log
+        self.headless=headless                  # True runs only the detection and EPICS output, without the Tk display
         self.send_epics=send_epics              # True enables data logging into EPICS variables  
         if self.send_epics:
             assert type(epics_prefix) == str , "the epics prefix should be a string"
         self.epics_prefix=epics_prefix
+        self.epics_backend=epics_backend        # how EPICS variables are written: 'pyepics', 'caput', 'pcaspy' (embedded IOC) or 'auto' (pyepics if installed)
           
-class filteredStream(Stream):
+class slidingWindow():
+    """
+    MAX, MIN and MEAN of the samples of a channel over the last 'length' seconds.
+
+    The window is updated only with the new samples: the candidates for the maximum (minimum) are kept in a monotonic
+    deque and the mean comes from a running sum over chunks of data, so the cost of an update is amortized O(new samples)
+    no matter how long the window is. Times are kept as POSIX timestamps (float).
+    """
+    def __init__(self, length, keepMean=True):
+        self.length=length
+        self.keepMean=keepMean
+        self.maxDeque=deque()   # (time, value), values strictly decreasing
+        self.minDeque=deque()   # (time, value), values strictly increasing
+        self.chunks=deque()     # (time of the first sample, delta, cumulative sum of the chunk)
+        self.total=0.0          # sum of the samples of all the chunks
+        self.count=0            # number of samples of all the chunks
+        self.start=None         # oldest time that is still in the window
+        self.delta=0.0          # sample period of the data
+
+    @staticmethod
+    def candidates(data, starttime, delta):
+        """
+        Samples of a chunk that can become the maximum (minimum) of a window: the ones that are larger (smaller) than every
+        sample after them in the chunk. They only depend on the chunk, so they can be shared by several windows.
+        :return: ((times, values, chunk maximum), (times, values, chunk minimum))
+        """
+        data=np.asarray(data, dtype=np.float64)
+        t0=float(starttime.timestamp)
+        result=[]
+        for reverseAccumulate, better in ((np.maximum.accumulate, np.greater), (np.minimum.accumulate, np.less)):
+            suffixBest=reverseAccumulate(data[::-1])[::-1]
+            keep=np.empty(len(data), dtype=bool)
+            keep[-1]=True
+            keep[:-1]=better(data[:-1], suffixBest[1:])
+            index=np.flatnonzero(keep)
+            result.append(((t0+delta*index).tolist(), data[index].tolist(), suffixBest[0]))
+        return result
+
+    def append(self, data, starttime, delta, candidates=None):
+        if len(data)==0:
+            return
+        if candidates is None:
+            candidates=self.candidates(data, starttime, delta)
+        self.delta=delta
+        for window, (times, values, best), better in ((self.maxDeque, candidates[0], float.__gt__), (self.minDeque, candidates[1], float.__lt__)):
+            while window and not better(window[-1][1], best):
+                window.pop()
+            window.extend(zip(times, values))
+        if self.keepMean:
+            cumsum=np.cumsum(data)
+            self.chunks.append((float(starttime.timestamp), delta, cumsum))
+            self.total+=cumsum[-1]
+            self.count+=len(data)
+
+    def expire(self, now):
+        #forget the samples older than now-length (nearest sample, as in Trace.slice)
+        self.start=float(now.timestamp)-self.length
+        for window in (self.maxDeque, self.minDeque):
+            while window and window[0][0]<self.start-self.delta/2:
+                window.popleft()
+        while self.chunks:
+            t0, delta, cumsum=self.chunks[0]
+            if t0+(len(cumsum)-1)*delta>=self.start-delta/2:
+                break
+            self.chunks.popleft()
+            self.total-=cumsum[-1]
+            self.count-=len(cumsum)
+        if not self.chunks: #start the sum over to avoid accumulating round off errors
+            self.total=0.0
+            self.count=0
+
+    def isEmpty(self):
+        return not self.maxDeque
+
+    @property
+    def max(self):
+        return self.maxDeque[0][1]
+
+    @property
+    def min(self):
+        return self.minDeque[0][1]
+
+    @property
+    def absmax(self):
+        #largest absolute value keeping its sign, like Trace.max()
+        return self.min if abs(self.min)>abs(self.max) else self.max
+
+    @property
+    def mean(self):
+        t0, delta, cumsum=self.chunks[0]
+        expired=min(max(int(np.ceil((self.start-t0)/delta-0.5)), 0), len(cumsum))
+        if expired==0:
+            return self.total/self.count
+        return (self.total-cumsum[expired-1])/(self.count-expired)
+
+class filteredStream(ringBufferStream):
     
-    def __init__(self, rawStream, myargs, filterTransientTime=180):
-        super(filteredStream, self).__init__()
+    def __init__(self, rawStream, myargs, filterTransientTime=180, clock=None):
+        #the filtered data is kept for twice the time that is displayed
+        super(filteredStream, self).__init__(buffer_time=2*myargs.backtrace_time)
         
         #self.lock=lock
         self.args=myargs
         self.filterTransientTime=filterTransientTime
+        self.filterInit=myargs.filter_init
+        self.startupTime=filterTransientTime if self.filterInit=='taper' else myargs.settle_time #filtered data discarded at the start of a channel
+        self.clock=realClock() if clock is None else clock
         
         #initialize the internal traces
         self.rawStream = rawStream
-        self.traces=rawStream.copy().traces
         
         #Define Brian's Lowpass filter that doesn't distort EQs [SEI aLog 2264]
         num =[ 0, 0.4726, 0.8728, 20.9151, 16.5637, 138.7922, 43.0012, 170.2783, 19.9420, 52.9641 ,0]
         den =[1.0000, 9.8557, 58.9535, 206.3141, 468.0879, 754.8555, 591.8468, 463.7391, 184.1213, 70.7469, 6.7789]
         self.filter=(num,den)
+        self.sosCache=dict() #discrete version of the filter for each sample period, see getSOS()
         
         #Internal states for Brian's filter
         self.customMetadata=dict()
-        for trace in self.traces:
+        self.windows=dict() #sliding windows with the statistics of each trace, see updateMetadata()
+        for trace in rawStream.copy().traces:
             self.customMetadata[trace.id]=dict()
             self.FirstLowpass(trace)
             
@@ -322,78 +811,789 @@ class filteredStream(Stream):
             hwp = np.append(hw, new)
             trace.data = trace.data * hwp # Apply window
             
-    #Function that applies a lowpass filter to an initial portion of data for which we have no internal filter states   
+    #Function that returns the second-order sections of Brian's filter for the sample period dt and their restart gain (see
+    #restartGain()), computed once per sample period. The continuous filter is discretized with a first-order hold (the same input
+    #interpolation used by signal.lsim). The poles and zeros are taken from the discrete state space directly, going through the
+    #polynomial coefficients is not accurate for a 10th order filter. The sos filter is only used if it gives the output of the lsim
+    #pipeline, called again every 'update_time' seconds, within 1e-6 of its largest value
+    def getSOS(self,dt):
+        if dt not in self.sosCache:
+            sos=continuousToSOS(self.filter, dt)
+            gain=restartGain(self.filter, sos, dt)
+            error=compareSOSWithLsim(self.filter, sos, gain, dt, chunk=self.args.update_time)
+            if error>1e-6:
+                logging.warning("SOS filter differs from lsim by %.2e for dt=%s, using lsim for this sample rate" % (error, dt))
+                self.sosCache[dt]=None
+            else:
+                self.sosCache[dt]=(sos, gain)
+        return self.sosCache[dt]
+
+    #Function that returns the internal state of Brian's filter after a constant input at the level of the first 'preroll_time'
+    #seconds of data (the steady state), in the form used by applyFilter() for the filter engine. Starting from it instead of
+    #from rest, there is no step from zero to the offset of the data and the filter output is usable after a few seconds.
+    def steadyState(self,data,dt):
+        level=np.mean(data[:max(int(round(self.args.preroll_time/dt)),1)])
+        filterSOS=self.getSOS(dt) if self.args.filter_engine=='sos' else None
+        if filterSOS is not None:
+            sos, gain=filterSOS
+            return (signal.sosfilt_zi(sos)+gain)*level
+        A, B, C, D=signal.tf2ss(*self.filter) #the same realization as signal.lsim
+        return linalg.solve(A, -B[:,0]*level)
+
+    #Function that runs Brian's filter over new data starting from the internal filter state (None means a filter at rest).
+    #Returns the filtered data and the new internal state, the state of the last sample as signal.lsim gives it.
+    def applyFilter(self,data,dt,state=None):
+        filterSOS=self.getSOS(dt) if self.args.filter_engine=='sos' else None
+        if filterSOS is not None:
+            sos, gain=filterSOS
+            if state is not None and np.shape(state)!=np.shape(gain): #state from the other engine, start over
+                state=None
+            return sosRestart(sos, gain, data, state)
+        if state is not None and np.ndim(state)!=1: #state from the other engine, start over
+            state=None
+        T=np.arange(0.0, len(data))
+        T *= dt
+        tout, yout, xout =signal.lsim(self.filter, data, T, X0=state)
+        return np.atleast_1d(yout), np.atleast_2d(xout)[-1] #lsim drops the time axis of a single sample
+
+    #Function that filters the new data of several channels that share the sample period dt in a single vectorized pass.
+    #'channels' is a list of (trace_id, data, starttime) where the data starts right after the saved filter state of the channel.
+    #Each channel is restarted like sosRestart() does. Channels usually have a different number of new samples: the samples that all
+    #the channels have (but the last one) are filtered in one call, then the rest of each longer channel from its own state and the
+    #last sample of every channel in one more call, so every filter state is saved at the last sample of its channel.
+    #Returns a list with the filtered data of each channel.
+    def filterBatch(self,channels,dt):
+        filterSOS=self.getSOS(dt) if self.args.filter_engine=='sos' else None
+        if filterSOS is None or len(channels)==1:
+            output=[]
+            for trace_id, data, starttime in channels:
+                yout, state=self.applyFilter(data, dt, state=self.customMetadata[trace_id]['filterState'])
+                self.customMetadata[trace_id]['filterState']=state
+                self.customMetadata[trace_id]['stateEndtime']=starttime+(len(data)-1)*dt
+                output.append(yout)
+            return output
+
+        sos, gain=filterSOS
+        lengths=np.array([len(data) for trace_id, data, starttime in channels])
+        common=lengths.min()-1
+        block=np.zeros((len(channels), lengths.max()))
+        states=np.zeros((sos.shape[0], len(channels), 2))
+        last=np.zeros((len(channels), 1))
+        for ii, (trace_id, data, starttime) in enumerate(channels):
+            block[ii,:lengths[ii]]=data
+            last[ii,0]=data[-1]
+            state=self.customMetadata[trace_id]['filterState']
+            if state is not None and np.shape(state)==np.shape(gain):
+                states[:,ii,:]=state
+            states[:,ii,:]-=gain*data[0]
+
+        if common>0:
+            block[:,:common], states=signal.sosfilt(sos, block[:,:common], axis=-1, zi=states)
+        for ii, (trace_id, data, starttime) in enumerate(channels):
+            if lengths[ii]-1>common:
+                block[ii,common:lengths[ii]-1], states[:,ii,:]=signal.sosfilt(sos, data[common:-1], zi=states[:,ii,:])
+        last, zf=signal.sosfilt(sos, last, axis=-1, zi=states)
+        for ii, (trace_id, data, starttime) in enumerate(channels):
+            block[ii,lengths[ii]-1]=last[ii,0]
+            self.customMetadata[trace_id]['filterState']=states[:,ii,:]+gain*data[-1]
+            self.customMetadata[trace_id]['stateEndtime']=starttime+(lengths[ii]-1)*dt
+
+        return [block[ii,:lengths[ii]] for ii in range(len(channels))]
+
+    #Function that applies a lowpass filter to an initial portion of data for which we have no internal filter states.
+    #With filter_init='taper' the data is tapered and filtered from rest, and the first 'filterTransientTime' seconds are
+    #discarded. With 'steady' the filter starts in the steady state of the first samples and only 'settle_time' is discarded
     def FirstLowpass(self,trace):
-            self.HanningWindow(trace)
             dt = trace.stats.delta
-            T=np.arange(0.0, len(trace.data))
-            T *= dt
-            tout, yout, xout =signal.lsim(self.filter, trace.data, T, X0=None)
-            trace.data = yout
-            trace.trim(starttime=trace.stats.starttime+self.filterTransientTime) #TODO: Change this to actually be useful, do we want to chop 3 minutes of data?
-            self.customMetadata[trace.id]['filterState']=xout[-1]
-            self.customMetadata[trace.id]['endtime']=trace.stats.endtime
+            endtime = trace.stats.endtime
+            self.customMetadata[trace.id]['rawStart']=trace.stats.starttime
+            self.customMetadata[trace.id]['firstSeen']=self.clock.now()
+            if self.filterInit=='steady':
+                trace.data, state = self.applyFilter(trace.data, dt, self.steadyState(trace.data, dt))
+            else:
+                self.HanningWindow(trace)
+                trace.data, state = self.applyFilter(trace.data, dt)
+            trace.trim(starttime=trace.stats.starttime+self.startupTime)
+            self.customMetadata[trace.id]['filterState']=state
+            self.customMetadata[trace.id]['stateEndtime']=endtime
+            self.customMetadata[trace.id]['endtime']=endtime #the data is filtered until the end of the raw data even if all the output was trimmed
+            self.customMetadata[trace.id]['validFrom']=trace.stats.starttime
+            if len(trace.data)!=0:
+                self.appendTrace(trace)
+                self.updateWindows(trace.id, trace.data, trace.stats.starttime, dt)
+                self.markValid(trace.id)
+
+    #Function that records when the first filtered sample of a channel was available, see startupMetrics()
+    def markValid(self, trace_id):
+        if 'firstValid' not in self.customMetadata[trace_id]:
+            self.customMetadata[trace_id]['firstValid']=self.clock.now()
+            logging.info("%s: first valid sample %.1f s after its data arrived" % (trace_id,
+                         self.customMetadata[trace_id]['firstValid']-self.customMetadata[trace_id].get('firstSeen', self.customMetadata[trace_id]['firstValid'])))
+
+    #Function that returns, for every channel that started (or started over after a long gap) in this run, the time from its
+    #first data to its first filtered sample ('time_to_first_valid', None until there is one) and the seconds of data lost
+    #to the start of the filter ('blind_time')
+    def startupMetrics(self):
+        metrics=dict()
+        for trace_id, values in self.customMetadata.items():
+            if 'firstSeen' not in values:
+                continue
+            metrics[trace_id]={'time_to_first_valid':values['firstValid']-values['firstSeen'] if 'firstValid' in values else None,
+                               'blind_time':values['validFrom']-values['rawStart'] if 'validFrom' in values else None}
+        return metrics
     
-    #Function that updates the filtered Stream with new data from the rawStream that is connected to it
-    def CollectAndAnalyze(self):
+    #Function that updates the filtered Stream with new data from the rawStream that is connected to it,
+    #'now' is the time used for the statistics windows (the time of the clock by default)
+    def CollectAndAnalyze(self, now=None):
+        self.filterNewData()
+        self.updateMetadata(now)
+
+    #Function that filters the data that arrived since the last call, of every channel or only of 'trace_ids'.
+    #Returns trace_id -> (filtered samples, starttime) of what was appended to the filtered buffers
+    def filterNewData(self, trace_ids=None):
         #with self.lock:
-        for trace in self.rawStream.traces:
-            if trace.id in self.getTraceIDs(): #if we have metadata for the trace TODO: change for 'if we have the trace in the filtered stream'
-                oldEndtime=self.customMetadata[trace.id]['endtime']
+        #Gather the new data of every channel, grouped by sample period
+        batches=dict()
+        appended=dict()
+        self.rawStream.releaseHeld(self.clock.now(), trace_ids) #packets held after a gap whose missing samples did not arrive in time
+        for trace_id in (self.rawStream.getTraceIDs() if trace_ids is None else trace_ids):
+            if trace_id not in self.rawStream.buffers:
+                continue
+            if trace_id in self.customMetadata: #if we have filter states for the trace
+                oldEndtime=self.customMetadata[trace_id]['endtime']
                 
-                #Trim traces to isolate the new data
-                if (trace.stats.endtime-oldEndtime)>0:
-                    dt = trace.stats.delta
-                    newTrace=trace.slice(starttime=oldEndtime+dt)
-                    trace_len=len(newTrace.data)
-
-                    #filter the new data and trim
-                    xin=self.customMetadata[newTrace.id]['filterState'];
-                    T=np.arange(0.0, trace_len)
-                    T *= dt
-                    tout, yout, xout =signal.lsim(self.filter, newTrace.data, T, X0=xin)
-                    newTrace.data = yout
-                    self.customMetadata[newTrace.id]['filterState']=xout[-1]
-                    self.customMetadata[newTrace.id]['endtime']=newTrace.stats.endtime
-                    self.append(newTrace)
+                #Read only the new data from the ring buffer, starting where the saved filter state is
+                rawBuffer=self.rawStream.buffers[trace_id]
+                if rawBuffer.starttime-self.customMetadata[trace_id]['stateEndtime']>1.5*rawBuffer.delta:
+                    #the raw buffer started over after a long gap, the saved filter state does not connect to its data
+                    self.customMetadata[trace_id]=dict()
+                    self.FirstLowpass(self.rawStream.sliceTrace(trace_id))
+                    continue
+                if (rawBuffer.endtime-oldEndtime)>0:
+                    newData=rawBuffer.getData(starttime=self.customMetadata[trace_id]['stateEndtime']+rawBuffer.delta)
+                    if len(newData)!=0:
+                        starttime=rawBuffer.endtime-(len(newData)-1)*rawBuffer.delta
+                        batches.setdefault(rawBuffer.delta, []).append((trace_id, newData, starttime))
                     
             else:#This trace is only present in the raw stream but has never been filtered
-                newTrace=trace.copy()
-                self.customMetadata[trace.id]=dict()
+                newTrace=self.rawStream.sliceTrace(trace_id)
+                self.customMetadata[trace_id]=dict()
                 self.FirstLowpass(newTrace)    
-                self.append(newTrace)
-                
-        #Merge and clean the trace information
-        self.merge(-1)
-        self.updateMetadata()
-        self.trim(UTCDateTime()-2*self.args.backtrace_time) #TODO: make this trim not arbitrary
-        for trace in self.traces:
-            trace.stats.processing = []
+
+        #Filter each group at once and scatter the results back into the filtered buffers
+        for dt, channels in batches.items():
+            for (trace_id, newData, starttime), filtered in zip(channels, self.filterBatch(channels, dt)):
+                #drop what was already filtered in the previous call or is still inside the transient of the first lowpass
+                validFrom=max(self.customMetadata[trace_id]['validFrom'], self.customMetadata[trace_id]['endtime']+dt)
+                self.customMetadata[trace_id]['endtime']=starttime+(len(newData)-1)*dt
+                if starttime<validFrom:
+                    skip=min(int(round((validFrom-starttime)/dt)), len(filtered))
+                    filtered=filtered[skip:]
+                    starttime=starttime+skip*dt
+                if len(filtered)==0:
+                    continue
+                if trace_id not in self.buffers:
+                    rawBuffer=self.rawStream.buffers[trace_id]
+                    self.buffers[trace_id]=traceRingBuffer(rawBuffer, capacity=int(np.ceil(self.buffer_time*rawBuffer.sampling_rate))+1)
+                self.buffers[trace_id].append(filtered, starttime)
+                self.updateWindows(trace_id, filtered, starttime, dt)
+                self.markValid(trace_id)
+                appended[trace_id]=(filtered, starttime)
+        return appended
             
-    #Function that returns the ids currently in the filtered stream        
-    def getTraceIDs(self):
-        return [tr.id for tr in self.traces]
+    #Function that copies the raw and filtered buffers and the filter states into arrays for saveCheckpoint()
+    def getCheckpoint(self):
+        arrays=self.rawStream.checkpointArrays("raw/")
+        arrays.update(self.checkpointArrays("filtered/"))
+        for trace_id, values in self.customMetadata.items():
+            if values.get('filterState') is None:
+                continue
+            arrays["state/"+trace_id+"/filterState"]=np.asarray(values['filterState'])
+            arrays["state/"+trace_id+"/times"]=np.array([values[key].timestamp for key in ('stateEndtime', 'endtime', 'validFrom')])
+        arrays["filter_engine"]=np.array(self.args.filter_engine)
+        return arrays
+
+    #Function that saves the buffers and filter states into a .npz file, so that a restarted picket fence can continue
+    #from them instead of downloading and filtering everything again. 'arrays' can be taken before with getCheckpoint()
+    #so that the stream lock is not held while writing
+    def saveCheckpoint(self, filename, arrays=None):
+        if arrays is None:
+            arrays=self.getCheckpoint()
+        temporary=filename+".tmp"
+        with open(temporary, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, filename) #a crash while saving does not destroy the previous checkpoint
+
+    #Function that restores a checkpoint saved by saveCheckpoint(). Data older than 'stream_time' is not restored, and the
+    #filter states are only used if they belong to the same filter engine. Returns the restored trace ids
+    def loadCheckpoint(self, filename, now):
+        if not os.path.exists(filename):
+            return []
+        try:
+            arrays=dict(np.load(filename))
+        except Exception as e:
+            logging.error("could not read the checkpoint %s: %s" % (filename, e))
+            return []
+        newest=max([arrays[key][1] for key in arrays if key.startswith("raw/") and key.endswith("/info")], default=0)
+        if now.timestamp-newest>self.args.stream_time:
+            logging.info("the checkpoint %s is too old, starting from scratch" % filename)
+            return []
+        restored=self.rawStream.restoreArrays(arrays, "raw/")
+        if str(arrays.get("filter_engine"))!=self.args.filter_engine:
+            return restored #the raw data is filtered again from the start
+        for trace_id in restored:
+            if "state/"+trace_id+"/filterState" not in arrays:
+                continue
+            stateEndtime, endtime, validFrom=[UTCDateTime(t) for t in arrays["state/"+trace_id+"/times"]]
+            self.customMetadata[trace_id]={'filterState':arrays["state/"+trace_id+"/filterState"],
+                                           'stateEndtime':stateEndtime, 'endtime':endtime, 'validFrom':validFrom}
+        for trace_id in self.restoreArrays(arrays, "filtered/"):
+            if trace_id not in self.customMetadata:
+                continue
+            buffer=self.buffers[trace_id]
+            self.updateWindows(trace_id, buffer.getData(), buffer.starttime, buffer.delta)
+        return restored
+
+    #Function that returns a plain Stream with the filtered data from 'starttime' on
+    def sliceStream(self, starttime=None):
+        return Stream(traces=[self.sliceTrace(trace_id, starttime) for trace_id in self.getTraceIDs()])
     
+    #Function that adds newly filtered samples to the 'lookback' and 'backtrace_time' windows of a trace
+    def updateWindows(self, trace_id, data, starttime, dt):
+        if trace_id not in self.windows:
+            self.windows[trace_id]=(slidingWindow(self.args.lookback), slidingWindow(self.args.backtrace_time))
+        candidates=slidingWindow.candidates(data, starttime, dt)
+        for window in self.windows[trace_id]:
+            window.append(data, starttime, dt, candidates)
+
     #This function keeps track of metadata for the traces over the last 'lookback' seconds
-    def updateMetadata(self):
-        #Grab statistics for the traces in the last 'lookback' seconds
-        for trace in self.traces:
-            dummyTrace=trace.slice(starttime=UTCDateTime()-self.args.lookback)
-            if len(dummyTrace.data)!=0:
-                self.customMetadata[trace.id]['MAX']=np.max(dummyTrace.data)
-                self.customMetadata[trace.id]['MIN']=np.min(dummyTrace.data)
-                self.customMetadata[trace.id]['MEAN']=np.mean(dummyTrace.data)
+    def updateMetadata(self, now=None):
+        if now is None:
+            now=self.clock.now()
+        for trace_id, (lookbackWindow, glitchWindow) in self.windows.items():
+            #Grab statistics for the traces in the last 'lookback' seconds
+            lookbackWindow.expire(now)
+            if not lookbackWindow.isEmpty():
+                self.customMetadata[trace_id]['MAX']=lookbackWindow.max
+                self.customMetadata[trace_id]['MAX_TIME']=lookbackWindow.maxDeque[0][0]  ## POSIX timestamp of the MAX
+                self.customMetadata[trace_id]['MIN']=lookbackWindow.min
+                self.customMetadata[trace_id]['MEAN']=lookbackWindow.mean
                 
-            #check for glitches too
-            dummyTrace=trace.slice(starttime=UTCDateTime()-self.args.backtrace_time)
-            if len(dummyTrace.data)!=0:
-                self.customMetadata[trace.id]['Glitch_ABSMAX']=dummyTrace.max()              
+            #check for glitches too, the statistics over the displayed time are also the ones sent to EPICS
+            glitchWindow.expire(now)
+            self.customMetadata[trace_id]['ACTIVE']=not glitchWindow.isEmpty() #the trace has data in the last 'backtrace_time' seconds
+            if not glitchWindow.isEmpty():
+                self.customMetadata[trace_id]['Glitch_ABSMAX']=glitchWindow.absmax
+                self.customMetadata[trace_id]['BACKTRACE_MAX']=glitchWindow.max
+                self.customMetadata[trace_id]['BACKTRACE_MIN']=glitchWindow.min
+                self.customMetadata[trace_id]['BACKTRACE_MEAN']=glitchWindow.mean
+def continuousToSOS(system, dt):
+    #converts a continuous (num, den) filter into discrete second-order sections using a first-order hold
+    A, B, C, D = signal.tf2ss(*system)
+    Ad, Bd, Cd, Dd, _ = signal.cont2discrete((A, B, C, D), dt, method='foh')
+    n = Ad.shape[0]
+    poles = linalg.eigvals(Ad)
+    # the zeros are the finite generalized eigenvalues of the system matrix
+    rosenbrock = np.block([[Ad, Bd], [Cd, Dd]])
+    E = np.zeros_like(rosenbrock)
+    E[:n, :n] = np.eye(n)
+    zeros = linalg.eigvals(rosenbrock, E)
+    zeros = zeros[np.isfinite(zeros)]
+    # match the gain at a frequency inside the pass band (0.1 Hz)
+    z0 = np.exp(2j * np.pi * 0.1 * dt)
+    H = (Cd @ np.linalg.solve(z0 * np.eye(n) - Ad, Bd) + Dd)[0, 0]
+    gain = np.real(H * np.prod(z0 - poles) / np.prod(z0 - zeros))
+    return signal.zpk2sos(zeros, poles, gain)
+
+def restartGain(system, sos, dt, duration=200):
+    #signal.lsim starts every call from X0, the state of the last sample of the previous call, at the time of the first new
+    #sample. The sos filter gives the same output when it starts from (state - gain*first sample) and saves (its state before
+    #the last sample + gain*last sample), with the states in the form of sosfilt. Returns 'gain', fitted on the responses of
+    #the sos filter from each of its states to the response of lsim to a single first sample
+    npts = max(int(duration / dt), 4 * sos.shape[0])
+    impulse = np.zeros(npts)
+    impulse[0] = 1.0
+    tout, yout, xout = signal.lsim(system, impulse, np.arange(npts) * dt, X0=None)
+    responses = np.zeros((npts, 2 * sos.shape[0]))
+    for ii in range(responses.shape[1]):
+        zi = np.zeros(responses.shape[1])
+        zi[ii] = 1.0
+        responses[:, ii] = signal.sosfilt(sos, np.zeros(npts), zi=zi.reshape(-1, 2))[0]
+    gain = np.linalg.lstsq(responses, signal.sosfilt(sos, impulse) - yout, rcond=None)[0]
+    return gain.reshape(-1, 2)
+
+def sosRestart(sos, gain, data, state=None):
+    #filters a new chunk of data with the sos filter like signal.lsim does when it is called again from 'state' (the state
+    #of the last sample of the previous chunk, see restartGain, None is the filter at rest). Returns the filtered data and
+    #the state of the last sample
+    if state is None:
+        state = np.zeros_like(gain)
+    yout = np.zeros(len(data))
+    zi = state - gain * data[0]
+    if len(data) > 1:
+        yout[:-1], zi = signal.sosfilt(sos, data[:-1], zi=zi)
+    yout[-1:], last = signal.sosfilt(sos, data[-1:], zi=zi)
+    return yout, zi + gain * data[-1]
+
+def compareSOSWithLsim(system, sos, gain, dt, chunk=2.0, duration=600):
+    #returns the largest difference between the pipeline with signal.lsim, called again for every new 'chunk' seconds of
+    #data (give or take a few samples), and the sos filter restarted the same way, on white noise, relative to the lsim output
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=int(duration / dt)) * 1000
+    lsimOut, sosOut = [], []
+    xin, state = None, None
+    start = 0
+    while start < len(data):
+        new = data[start:start + max(int(chunk / dt) + int(rng.integers(-3, 4)), 1)]
+        tout, yout, xout = signal.lsim(system, new, np.arange(len(new)) * dt, X0=xin)
+        xin = np.atleast_2d(xout)[-1]
+        lsimOut.append(np.atleast_1d(yout))
+        yout, state = sosRestart(sos, gain, new, state)
+        sosOut.append(yout)
+        start += len(new)
+    lsimOut, sosOut = np.concatenate(lsimOut), np.concatenate(sosOut)
+    return np.max(np.abs(lsimOut - sosOut)) / np.max(np.abs(lsimOut))
+
+class detectionEngine():
+    """
+    Runs the earthquake detection of the picket fence on its own thread, independently of the display.
+
+    Every 'update_time' seconds it filters the new data (filteredStream.CollectAndAnalyze), classifies each station as
+    gray/yellow/orange/red or as a potential glitch and writes the EPICS variables. The result of the last cycle is kept
+    in self.snapshot so that a display (SeedlinkPlotter) can show it without taking part in the detection.
+    """
+    #background color that the display uses for each station level
+    colors=LEVEL_COLORS
+    #order of the levels of an earthquake, a higher level is never lowered by a packetDetector
+    levelOrder={LEVEL_NAMES[code]:code for code in range(GRAY, RED+1)}
+
+    def __init__(self, stream, picket_dict, myargs, lock, writer=None, clock=None, associator=None):
+        self.stream=stream
+        self.clock=realClock() if clock is None else clock
+        self.pickets=picket_dict
+        self.args=myargs
+        self.lock=lock
+        self.threshold=myargs.threshold
+        self.send_epics=myargs.send_epics
+        self.epics_prefix=myargs.epics_prefix
+        self.writer=writer  # EPICS writer from Picket_fence_epics, only used if send_epics
+        self.associator=associator  # associationEngine that confirms the triggers of several stations, None judges every station alone
+        self.classifier=stationClassifier(sorted(picket_dict.keys()), threshold=myargs.threshold, hold_time=myargs.level_hold_time)
+        self.glitchAux=None  # value for NETWORK_AUX1 found by classify(), None if it should not be written
+        self.siteAux=None  # (GPS arrival, lead time) of the event at the observatory for NETWORK_AUX2/AUX3, None if they should not be written
+        self.location=None  # location of the event that was printed last
+        self.snapshot=None  # {'time', 'levels', 'glitches'} of the last cycle
+        self.escalations=dict()  # station -> level raised by a packetDetector since the statistics of this cycle were taken
+        self.networkPeak=0  # NETWORK_PEAK and station -> MAX last written, a packetDetector only writes higher peaks
+        self.stationPeaks=dict()
+        self.writerLock=threading.Lock()  # the writer is shared with the packetDetector, on the threads of the clients
+        self.timer=stageTimer('detection', myargs.update_time)  # duration of the stages of every cycle
+        self.stop_event=threading.Event()
+        self.thread=None
+
+    def start(self):
+        self.thread=threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        
+    def run(self):
+        while not self.stop_event.is_set():
+            start=perf_counter()
+            try:
+                self.step(self.clock.now())
+            except Exception as e:
+                logging.error(e)
+            dt=perf_counter()-start
+            self.stop_event.wait(max(self.args.update_time-dt, 0))
+
+    #One detection cycle: filter, classify and publish. 'now' is used for the whole cycle, every stage is timed
+    def step(self, now):
+        self.timer.begin()
+        try:
+            with self.timer.stage('lock'):
+                self.lock.acquire()
+            try:
+                with self.timer.stage('filter'):
+                    self.stream.filterNewData()
+                with self.timer.stage('statistics'):
+                    self.stream.updateMetadata(now)
+                    metadata={trace_id:dict(values) for trace_id, values in self.stream.customMetadata.items() if values.get('ACTIVE')}
+                self.escalations=dict()  ## the statistics now include the packets that raised them
+            finally:
+                self.lock.release()
+            if not metadata:
+                raise Exception("Empty stream for detection")
+
+            #stations in the same order as a sorted Stream
+            trace_ids=sorted(metadata.keys(), key=lambda trace_id: tuple(trace_id.split('.')))
+            with self.timer.stage('classify'):
+                levels=self.classify(trace_ids, metadata, now)
+            if self.associator is not None:
+                with self.timer.stage('associate'):
+                    self.associate(trace_ids, metadata, levels, now)
+            if self.send_epics:
+                with self.timer.stage('publish'):
+                    self.publish(trace_ids, metadata, levels)
+            with self.writerLock:
+                #keep the levels raised by a packetDetector from packets that came after the statistics were taken
+                for station, level in self.escalations.items():
+                    if levels.get(station, 'gray')!='glitch' and self.levelOrder[level]>self.levelOrder[levels.get(station, 'gray')]:
+                        levels[station]=level
+                self.snapshot={'time':now, 'levels':levels, 'glitches':list(self.POTENTIAL_GLITCHES)}
+        finally:
+            self.timer.end()
+
+    #Stations flagged as potential glitches by the classifier
+    @property
+    def POTENTIAL_GLITCHES(self):
+        return self.classifier.glitchNames()
+
+    #Function that assigns a level ('gray', 'yellow', 'orange', 'red' or 'glitch') to each station with data, all at
+    #once with the stationClassifier, and finds the value of NETWORK_AUX1
+    def classify(self, trace_ids, metadata, now=None):
+        now=self.clock.now() if now is None else now
+        names=[trace_id.split('.')[1] for trace_id in trace_ids]
+        codes, aux=self.classifier.update(names, [metadata[trace_id].get('MAX', np.nan) for trace_id in trace_ids],
+                                          [metadata[trace_id].get('Glitch_ABSMAX', np.nan) for trace_id in trace_ids], now.timestamp)
+        ## update AUX1 channel to hold picket number that is glitching, -1 if several were cleared
+        self.glitchAux=self.pickets[aux]['index'] if isinstance(aux, str) else aux
+        return self.classifier.levelDict(names, codes)
+
+    #Function that hands the triggers (time of the peak that raised a station above gray) to the associationEngine and
+    #applies its decisions: the stations of a confirmed event are not glitches, an isolated trigger is shown as one
+    def associate(self, trace_ids, metadata, levels, now):
+        for trace_id in trace_ids:
+            trace_name=trace_id.split('.')[1]
+            if levels[trace_name]=='gray':
+                self.associator.clear(trace_name)
+            elif 'MAX_TIME' in metadata[trace_id]:
+                self.associator.trigger(trace_name, metadata[trace_id]['MAX_TIME'])
+        statuses, event=self.associator.associate(now.timestamp)
+        if event is not None:
+            print("%s Event confirmed by %s, first trigger %s (%.1f s before)" % (now.strftime("%Y-%m-%d %H:%M:%S"),
+                  ", ".join(event['stations']), UTCDateTime(event['time']).strftime("%H:%M:%S"), event['delay']))
+
+        self.predictArrival(now)
+
+        cleared=[trace_name for trace_name in self.POTENTIAL_GLITCHES if statuses.get(trace_name)=='confirmed']
+        self.classifier.clearGlitches(cleared)
+        for trace_name in cleared:  ## an earthquake large enough to look like a glitch
+            levels[trace_name]='red'
+        if cleared:
+            self.glitchAux=-1
+        for trace_name, status in statuses.items():
+            if status=='isolated' and levels.get(trace_name) in ('yellow', 'orange', 'red'):
+                levels[trace_name]='glitch'
+
+    #Function that gives the arrival of the located event at the observatory (GPS seconds) and the time left until
+    #then, for NETWORK_AUX2 and NETWORK_AUX3. They go back to -1 once when the event is over
+    def predictArrival(self, now):
+        event=self.associator.event
+        location=event['location'] if event is not None else None
+        if location is None:
+            if self.siteAux is not None:
+                self.siteAux=None if self.siteAux==(-1, -1) else (-1, -1)
+            return
+        arrival=location['site_arrival'][self.associator.grid.trigger_phase]
+        self.siteAux=(int(tconvert(UTCDateTime(arrival).datetime).seconds), int(round(arrival-now.timestamp)))
+        if location is not self.location:
+            self.location=location
+            print("%s Event at %.1f, %.1f (%.1f s rms, %d stations), waves at the site at %s, in %.0f s (located in %.1f ms)" % (
+                  now.strftime("%Y-%m-%d %H:%M:%S"), location['latitude'], location['longitude'], location['rms'], len(event['stations']),
+                  UTCDateTime(arrival).strftime("%H:%M:%S"), arrival-now.timestamp, 1e3*event['locate_time']))
+
+    #Function that writes the station statistics over the displayed time and the network peak into EPICS, all in one batch
+    def publish(self, trace_ids, metadata, levels):
+        prefix=self.epics_prefix
+        values=[]
+        if self.glitchAux is not None:
+            values.append((prefix + "NETWORK_AUX1", self.glitchAux))
+        if self.siteAux is not None:
+            values += [(prefix + "NETWORK_AUX2", self.siteAux[0]), (prefix + "NETWORK_AUX3", self.siteAux[1])]
+        station_names=[trace_id.split('.')[1] for trace_id in trace_ids]
+        dead_ids=[key for key in self.pickets.keys() if key not in station_names]
+        for id_ in dead_ids:
+            starter = stationPrefix(self.pickets[id_]['index'])
+            values += [(prefix + starter + "MIN", -1), (prefix + starter + "MAX", -1), (prefix + starter + "MEAN", -1)]
+
+        idx = -1
+        max_val = 0
+        for i, trace_id in enumerate(trace_ids):
+            if levels[station_names[i]]=='glitch':  ## won't consider glitches info for NETWORK EPICs
+                continue
+            mn = metadata[trace_id]['BACKTRACE_MIN']
+            mx = metadata[trace_id]['BACKTRACE_MAX']
+            best = mn if abs(mn) > abs(mx) else mx
+            if abs(max_val) < abs(best):
+                idx = i
+                max_val = abs(best)
+
+        for trace_id, station in zip(trace_ids, station_names):
+            starter = stationPrefix(self.pickets[station]['index'])
+            values += [(prefix + starter + "MIN", metadata[trace_id]['BACKTRACE_MIN']),
+                       (prefix + starter + "MAX", metadata[trace_id]['BACKTRACE_MAX']),
+                       (prefix + starter + "MEAN", metadata[trace_id]['BACKTRACE_MEAN'])]
+        values += [(prefix + "NETWORK_PEAK", max_val),
+                   (prefix + "NETWORK_STATION_NUM", self.pickets[station_names[idx]]['index']),
+                   (prefix + "NETWORK_STATION_NAME", station_names[idx]),
+                   (prefix + "SERVER_GPS", tconvert('now').seconds)]
+        with self.writerLock:
+            self.writer.putMany(values)
+            self.networkPeak=max_val
+            self.stationPeaks={station:metadata[trace_id]['BACKTRACE_MAX'] for trace_id, station in zip(trace_ids, station_names)}
+
+class packetDetector():
+    """
+    Checks every packet against the thresholds as soon as it is written to the raw stream, instead of waiting for the
+    next cycle of the detectionEngine (up to 'update_time' seconds later).
+
+    The new samples of the channel are filtered at once (filteredStream.filterNewData of that channel only, the next
+    detection cycle has nothing left to filter for it) and their peak is compared with the threshold, 2x and 10x. When
+    it raises the level of the station, the level is changed in engine.snapshot for the display and, with send_epics,
+    the station MAX and the network peak are written right away. Lower levels and glitches are left to the detection
+    cycle, which looks at the whole 'lookback' window: peaks above the glitch level are not alerted on here.
+    """
+    def __init__(self, stream, engine, lock, length=1000):
+        self.stream=stream  # filteredStream
+        self.engine=engine
+        self.lock=lock  # lock of the raw and filtered streams
+        self.verbose=True  # False does not print the alerts
+        self.packets=0
+        self.alerts=[]  # (time, station, old level, new level, peak) of every level raised
+        self.latencies=deque(maxlen=length)  # seconds from the arrival of the last packets to the end of their check
+
+    #Level of a peak of the filtered data, None for a potential glitch
+    def level(self, peak):
+        code=int(self.engine.classifier.levelOf(peak))
+        return None if code==GLITCH else LEVEL_NAMES[code]
+
+    #Called by SeedlinkUpdater.handleTrace after the packet of 'trace_id' was written, 'arrival' is its perf_counter()
+    def onPacket(self, trace_id, arrival):
+        with self.lock:
+            appended=self.stream.filterNewData([trace_id]).get(trace_id)
+        if appended is None:  ## nothing new, or the channel is still inside its startup
+            return
+        filtered, starttime=appended
+        peakIndex=int(np.argmax(filtered))
+        peak=float(filtered[peakIndex])
+        level=self.level(peak)
+        station=trace_id.split('.')[1]
+        if level is not None and station not in self.engine.POTENTIAL_GLITCHES:
+            with self.engine.writerLock:
+                snapshot=self.engine.snapshot
+                levels=snapshot['levels'] if snapshot is not None else dict()
+                old=levels.get(station, 'gray')
+                if old!='glitch' and self.engine.levelOrder[level]>self.engine.levelOrder[old]:
+                    self.escalate(station, old, level, peak, snapshot)
+                    if old=='gray' and self.engine.associator is not None:
+                        self.engine.associator.trigger(station, (starttime+peakIndex*self.stream.buffers[trace_id].delta).timestamp)
+        self.packets+=1
+        self.latencies.append(perf_counter()-arrival)
+
+    #Raises the level of a station in the snapshot of the engine and writes its peak, with the engine writer lock held
+    def escalate(self, station, old, level, peak, snapshot):
+        now=self.engine.clock.now()
+        if snapshot is None:
+            snapshot={'time':now, 'levels':dict(), 'glitches':[]}
+        self.engine.escalations[station]=level
+        self.engine.snapshot=dict(snapshot, levels=dict(snapshot['levels'], **{station:level}))
+        self.alerts.append((now, station, old, level, peak))
+        if self.engine.send_epics and station in self.engine.pickets:
+            prefix=self.engine.epics_prefix
+            values=[]
+            if peak>self.engine.stationPeaks.get(station, 0):
+                values.append((prefix + stationPrefix(self.engine.pickets[station]['index']) + "MAX", peak))
+                self.engine.stationPeaks[station]=peak
+            if peak>self.engine.networkPeak:
+                values += [(prefix + "NETWORK_PEAK", peak),
+                           (prefix + "NETWORK_STATION_NUM", self.engine.pickets[station]['index']),
+                           (prefix + "NETWORK_STATION_NAME", station)]
+                self.engine.networkPeak=peak
+            if values:
+                try:
+                    self.engine.writer.putMany(values)
+                except Exception as e:
+                    logging.error(e)
+        if self.verbose:
+            print("%s %s: %s -> %s (packet peak %.0f)" % (now.strftime("%Y-%m-%d %H:%M:%S"), station, old, level, peak))
+
+    def metrics(self):
+        summary={'packets':self.packets, 'alerts':len(self.alerts)}
+        if self.latencies:
+            summary['latency_ms']={key:1e3*value for key, value in rollingStats(self.latencies).items()}
+        return summary
+
+class envelopeDecimator():
+    """
+    Min/max envelope of a trace with one column per pixel of the display.
+
+    Columns are aligned to absolute time ('width' seconds each), so a column never changes once its samples are in:
+    new samples only update the last column or add new ones. Drawing the minimum and the maximum of every column
+    keeps all the peaks of the trace visible with two points per pixel instead of every sample.
+    """
+    def __init__(self, width, length):
+        self.width=width        # seconds per column
+        self.length=length      # seconds of columns that are kept
+        self.cols=np.empty(0, dtype=np.int64)
+        self.mins=np.empty(0, dtype=np.float64)
+        self.maxs=np.empty(0, dtype=np.float64)
+        self.lastTime=None      # time of the last sample that went into the columns
+
+    def append(self, data, starttime, delta):
+        if not len(data):
+            return
+        cols=np.floor((starttime.timestamp+np.arange(len(data))*delta)/self.width).astype(np.int64)
+        starts=np.concatenate(([0], np.flatnonzero(np.diff(cols))+1))
+        newCols=cols[starts]
+        newMins=np.minimum.reduceat(data, starts)
+        newMaxs=np.maximum.reduceat(data, starts)
+        if len(self.cols) and self.cols[-1]==newCols[0]:
+            #the first new samples fall into the last (partial) column
+            self.mins[-1]=min(self.mins[-1], newMins[0])
+            self.maxs[-1]=max(self.maxs[-1], newMaxs[0])
+            newCols, newMins, newMaxs=newCols[1:], newMins[1:], newMaxs[1:]
+        keep=self.cols >= newCols[-1]-int(np.ceil(self.length/self.width))-1 if len(newCols) else slice(None)
+        self.cols=np.concatenate((self.cols[keep], newCols))
+        self.mins=np.concatenate((self.mins[keep], newMins))
+        self.maxs=np.concatenate((self.maxs[keep], newMaxs))
+        self.lastTime=starttime+(len(data)-1)*delta
+
+    def envelope(self, starttime, endtime):
+        #x (seconds relative to 'endtime') and y of the envelope between 'starttime' and 'endtime'
+        inside=(self.cols >= np.floor(starttime.timestamp/self.width)) & (self.cols <= np.floor(endtime.timestamp/self.width))
+        x=(self.cols[inside]+0.5)*self.width-endtime.timestamp
+        y=np.column_stack((self.mins[inside], self.maxs[inside])).ravel()
+        return np.repeat(x, 2), y
+
+
+class blitRenderer():
+    """
+    Draws the stations of the picket fence on a figure with blitting.
+
+    The axes, labels, ticks and station colors are drawn once into a background. Each refresh restores that background
+    and draws only the trace lines and the time stamp. The lines are the min/max envelopes of the traces with one column
+    per pixel (envelopeDecimator), collect() only reads the samples that arrived since the previous refresh. The time axis is relative to the time stamp (minutes before it), so
+    it does not move between refreshes. The background is rebuilt when the station set, the station colors or the canvas
+    size change, or when a trace leaves its vertical range.
+    It only needs an Agg canvas, so it also works without Tk.
+    """
+    def __init__(self, figure, myargs):
+        self.figure=figure
+        self.args=myargs
+        self.layoutKey=None
+        self.background=None
+        self.axes=dict()        # trace id -> axis
+        self.lines=dict()       # trace id -> Line2D
+        self.ylims=dict()       # trace id -> (bottom, top) of the axis
+        self.decimators=dict()  # trace id -> envelopeDecimator
+        self.columns=0          # number of envelope columns, the width of the canvas in pixels
+        self.timeText=None
+        self.figure.canvas.mpl_connect('draw_event', self.onDraw)
+
+    def onDraw(self, event):
+        #any full draw (ours, or a resize of the window) gives the new background
+        self.background=self.figure.canvas.copy_from_bbox(self.figure.bbox)
+
+    def invalidate(self):
+        self.layoutKey=None
+
+    def yLimits(self, data):
+        #vertical range of an axis, at least 'threshold' wide so that quiet stations do not show their noise at full scale,
+        #with some headroom so that the noise does not push the trace out of its axis on every refresh
+        if not len(data):
+            return (-self.args.threshold/2, self.args.threshold/2)
+        bottom, top=float(np.min(data)), float(np.max(data))
+        middle, half=(top+bottom)/2, max(top-bottom, self.args.threshold)/2*1.5
+        return (middle-half, middle+half)
+
+    def needsLayout(self, trace_id, data):
+        #the axis is redrawn when the data leaves it or only uses a small part of it
+        if not len(data):
+            return False
+        bottom, top=self.ylims[trace_id]
+        low, high=float(np.min(data)), float(np.max(data))
+        if low < bottom or high > top:
+            return True
+        return (top-bottom) > 6*max(high-low, self.args.threshold)
+
+    def collect(self, stream, start_time, stop_time):
+        #envelopes of the traces of 'stream' (a ringBufferStream) between start_time and stop_time, as a list of
+        #(trace id, x, y); it reads the stream, so it has to be called with the stream lock held
+        columns=self.figure.canvas.get_width_height()[0]
+        if columns != self.columns:
+            self.columns=columns
+            self.decimators=dict()
+        envelopes=[]
+        for trace_id in stream.getTraceIDs():
+            decimator=self.decimators.get(trace_id)
+            if decimator is None:
+                decimator=envelopeDecimator(self.args.backtrace_time/self.columns, self.args.backtrace_time)
+                self.decimators[trace_id]=decimator
+            trace=stream.sliceTrace(trace_id, start_time if decimator.lastTime is None else
+                                    max(start_time, decimator.lastTime+stream.buffers[trace_id].delta))
+            decimator.append(trace.data, trace.stats.starttime, trace.stats.delta)
+            envelopes.append((trace_id,)+decimator.envelope(start_time, stop_time))
+        return envelopes
+
+    def layout(self, envelopes, colors, stop_time):
+        fig=self.figure
+        fig.clear()
+        self.axes, self.lines, self.ylims=dict(), dict(), dict()
+        bbox = dict(boxstyle="round", fc="w", alpha=0.8 if len(envelopes) <= 5 else 0.6)
+        path_effects = [withStroke(linewidth=4, foreground="w")]
+        pad = 10
+        axes=fig.subplots(len(envelopes), 1, sharex=True, squeeze=False)[:, 0]
+        fig.subplots_adjust(left=0, right=1, top=1, bottom=0, hspace=0)
+        for ax, (trace_id, x, data) in zip(axes, envelopes):
+            ax.set_facecolor(colors[trace_id])
+            ax.text(0.02, 0.95, trace_id, transform=ax.transAxes, va="top", ha="left",
+                    fontsize=self.args.title_size, path_effects=path_effects)
+            self.ylims[trace_id]=self.yLimits(data)
+            ax.set_ylim(*self.ylims[trace_id])
+            ax.set_xlim(-self.args.backtrace_time, 0)
+            ax.yaxis.set_major_locator(MaxNLocator(nbins=4, prune="both"))
+            plt.setp(ax.get_yticklabels(), ha="left", path_effects=path_effects)
+            ax.yaxis.set_tick_params(pad=-pad)
+            ax.grid(True, axis="x")
+            line,=ax.plot([], [], color='Blue', linewidth=1, animated=True)
+            self.axes[trace_id]=ax
+            self.lines[trace_id]=line
+        bottom=axes[-1]
+        bottom.xaxis.set_major_locator(MultipleLocator(max(60, round(self.args.backtrace_time/self.args.time_tick_nb/60)*60)))
+        bottom.xaxis.set_major_formatter(plt.FuncFormatter(lambda x, pos: "%d min" % round(x/60) if x else "0"))
+        plt.setp(bottom.get_xticklabels(), va="bottom", size=self.args.time_legend_size, bbox=bbox)
+        bottom.xaxis.set_tick_params(pad=-pad)
+        self.timeText=fig.text(0.99, 0.97, stop_time.strftime("%Y-%m-%d %H:%M:%S UTC"),
+                               ha="right", va="top", bbox=bbox, fontsize="medium", animated=True)
+        fig.canvas.draw()
+
+    def render(self, envelopes, levels, stop_time):
+        #envelopes comes from collect()
+        colors={trace_id: detectionEngine.colors[levels.get(trace_id.split('.')[1], 'gray')] for trace_id, x, y in envelopes}
+        key=(tuple(colors.items()), self.figure.canvas.get_width_height())
+        if key != self.layoutKey or self.background is None or \
+                any(self.needsLayout(trace_id, y) for trace_id, x, y in envelopes):
+            self.layout(envelopes, colors, stop_time)
+            self.layoutKey=key
+        canvas=self.figure.canvas
+        canvas.restore_region(self.background)
+        for trace_id, x, y in envelopes:
+            line=self.lines[trace_id]
+            line.set_data(x, y)
+            self.axes[trace_id].draw_artist(line)
+        self.timeText.set_text(stop_time.strftime("%Y-%m-%d %H:%M:%S UTC"))
+        self.figure.draw_artist(self.timeText)
+        canvas.blit(self.figure.bbox)
+
+
 class SeedlinkPlotter(tkinter.Tk):
     """
     This module plots realtime seismic data from a Seedlink server
     """
-    def __init__(self, stream=None, picket_dict=None, events=None, myargs=None, lock=None, leave=[False],
-                 *args, **kwargs): # , send_epics=False
+    def __init__(self, stream=None, picket_dict=None, events=None, myargs=None, lock=None, leave=[False], engine=None,
+                 clock=None, *args, **kwargs): # , send_epics=False
         tkinter.Tk.__init__(self, *args, **kwargs)
         self.wm_title("seedlink-plotter {}".format("Picket Fence v2"))
         self.focus_set()
@@ -423,15 +1623,17 @@ class SeedlinkPlotter(tkinter.Tk):
         self.canvas = canvas
         self.args = args
         self.pickets=picket_dict
-        self.send_epics=self.args.send_epics
-        self.epics_prefix=self.args.epics_prefix
         self.leave=leave
         self.stream = stream
+        self.engine = engine  ## the detection runs in the engine, the plotter only displays its results
+        self.clock = realClock() if clock is None else clock
         self.events = events
         self.threshold = args.threshold
         self.lookback = args.lookback
         self.color = ('#000000', '#e50000', '#0000e5', '#448630')  ## Regular colors: Black, Red, Blue, Green
-        self.POTENTIAL_GLITCHES = []
+        self.renderer = blitRenderer(self.figure, args) if args.render_mode == 'blit' else None
+        self.timer = stageTimer('display', args.update_time)  # duration of the stages of every refresh
+        canvas.get_tk_widget().bind('<Configure>', self._resize, add='+')
         self.plot_graph()
 
     def _close_window(self):
@@ -446,6 +1648,17 @@ class SeedlinkPlotter(tkinter.Tk):
         self.bind('q', self._quit)
         self.protocol("WM_DELETE_WINDOW", self._close_window)
         self.bind('f', self._toggle_fullscreen)
+        self.bind('p', self._profile)
+
+    def _resize(self, event):
+        if self.renderer is not None:
+            self.renderer.invalidate()
+
+    def _profile(self, event):
+        ## profiles the next cycles of the display and of the detection
+        self.timer.requestProfile()
+        if self.engine is not None:
+            self.engine.timer.requestProfile()
 
     def _toggle_fullscreen(self, event):
         g = self.geometry()
@@ -453,70 +1666,49 @@ class SeedlinkPlotter(tkinter.Tk):
         self._geometry = g
 
     def plot_graph(self):
-        now = UTCDateTime()
+        start = perf_counter()
+        now = self.clock.now()
         self.start_time = now - self.backtrace
         self.stop_time = now
 
-        with self.lock:
-            self.stream.CollectAndAnalyze()
-            stream=self.stream.copy()
+        snapshot = self.engine.snapshot
+        self.timer.begin()
         try:
-            logging.info(str(stream.split()))
-            if not stream:
-                raise Exception("Empty stream for plotting")
-                
-            threshold = self.threshold # 500 nm/s normally, can be changed in the parameters
-            ## in this function, the color lists may have glitched traces in them. We want this
-            red_list = []
-            orange_list = []
-            yellow_list = []
-            
-            for trace in stream:
-                max_val=stream.customMetadata[trace.id]['MAX']
-                max_val_over_trace=stream.customMetadata[trace.id]['Glitch_ABSMAX']
-                trace_name=trace.stats.station
-            
-                if max_val > 50000:  ## potential glitch
-                    if trace_name not in self.POTENTIAL_GLITCHES:
-                        self.POTENTIAL_GLITCHES.append(trace_name)
-                elif max_val > 10*threshold:  ## should be red
-                    if trace not in red_list:
-                        red_list.append(trace)
-                elif max_val > 2*threshold:  ## should be orange
-                    if trace not in orange_list:
-                        orange_list.append(trace)
-                elif max_val > threshold:  ## should be yellow
-                    if trace_name in self.POTENTIAL_GLITCHES:
-                        if max_val_over_trace < 2 * threshold:  ## potential glitch no longer glitching
-                            self.POTENTIAL_GLITCHES.remove(trace_name)
-                    if trace not in yellow_list:
-                        yellow_list.append(trace)
-                else:  ## should be gray
-                    if trace_name in self.POTENTIAL_GLITCHES:
-                        if max_val_over_trace < 200:  ## potential glitch no longer glitching
-                            self.POTENTIAL_GLITCHES.remove(trace_name)
-            stream.trim(starttime=self.start_time, endtime=self.stop_time)
-            np.set_printoptions(threshold=np.inf)
-            self.plot_lines(stream, red_list, orange_list, yellow_list)
+            if snapshot is None:
+                raise Exception("No detection results to plot yet")
+            with self.timer.stage('lock'):
+                self.lock.acquire()
+            try:
+                with self.timer.stage('collect'):
+                    if self.renderer is not None:
+                        ## only the samples that arrived since the last refresh are read, as per-pixel envelopes
+                        envelopes=self.renderer.collect(self.stream, self.start_time, self.stop_time)
+                    else:
+                        stream=self.stream.sliceStream(starttime=self.start_time)
+            finally:
+                self.lock.release()
+            with self.timer.stage('render'):
+                if self.renderer is not None:
+                    if not envelopes:
+                        raise Exception("Empty stream for plotting")
+                    self.renderer.render(envelopes, snapshot['levels'], self.stop_time)
+                else:
+                    logging.info(str(stream.split()))
+                    if not stream:
+                        raise Exception("Empty stream for plotting")
+
+                    stream.trim(starttime=self.start_time, endtime=self.stop_time)
+                    self.plot_lines(stream, snapshot['levels'])
 
         except Exception as e:
             logging.error(e)
             pass
-        dt=UTCDateTime()-now
-        self.after(int(np.max(self.args.update_time-dt,0) * 1000), self.plot_graph)
+        self.timer.end()
+        dt=perf_counter()-start
+        self.after(int(max(self.args.update_time-dt,0) * 1000), self.plot_graph)
 
-    def plot_lines(self, stream, red_list, orange_list, yellow_list):
-        
-        trace_ids=[trace.stats.station for trace in stream]
-        dead_ids=[key for key in self.pickets.keys() if key not in trace_ids]
+    def plot_lines(self, stream, levels):
         
-        if self.send_epics:
-            prefix=self.epics_prefix
-            for id_ in dead_ids:
-                starter = "STATION_0" + self.pickets[id_]['index'] + "_"
-                subprocess.Popen(["caput", prefix + starter + "MIN", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "MAX", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "MEAN", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         stream.sort()
         self.figure.clear()
         fig = self.figure
@@ -525,17 +1717,6 @@ class SeedlinkPlotter(tkinter.Tk):
         for trace in stream:
             trace.stats.processing = []
         
-                
-        if len(self.POTENTIAL_GLITCHES) == 1:  ## if station is glitching, dont display EPICs variables
-            trace_name = self.POTENTIAL_GLITCHES[0]
-            i = self.pickets[trace_name]['index']
-            ## update AUX1 channel to hold picket number that is glitching
-            if self.send_epics:
-                subprocess.Popen(["caput", self.epics_prefix + "NETWORK_AUX1", f"{i}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        elif len(self.POTENTIAL_GLITCHES) > 1:  ## if multiple "glitches", they are probably not glitching (very large EQ??)
-            if self.send_epics:
-                subprocess.Popen(["caput", self.epics_prefix + "NETWORK_AUX1", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            self.POTENTIAL_GLITCHES.clear() ## since they aren't glitching, remove them from list
         # Change equal_scale to False if auto-scaling should be turned off
         stream.plot(fig=fig, method="fast", draw=False, equal_scale=False,
                     size=(self.args.x_size, self.args.y_size), title="",
@@ -595,58 +1776,10 @@ class SeedlinkPlotter(tkinter.Tk):
         fig.text(0.99, 0.97, self.stop_time.strftime("%Y-%m-%d %H:%M:%S UTC"),
                  ha="right", va="top", bbox=bbox, fontsize="medium")
 
-        ## update to remove glitches from red/orange/yellow lists
-        for trace_name in self.POTENTIAL_GLITCHES:
-            trace = name_get_trace(stream, trace_name)
-            if trace in red_list:
-                red_list.remove(trace)
-            elif trace in orange_list:
-                orange_list.remove(trace)
-            elif trace in yellow_list:
-                yellow_list.remove(trace)
-            else:
-                continue
-
-        ## change color of traces
+        ## change color of traces according to the levels of the detection engine
         for j in range(len(stream)):
             trace = stream[j]  ## grab trace
-            if trace_get_name(trace) in self.POTENTIAL_GLITCHES:  ## display glitch in a different color
-                fig.axes[j].set_facecolor("#00FFFF")
-            elif trace in red_list:
-                fig.axes[j].set_facecolor("#FF2929")
-            elif trace in orange_list:
-                fig.axes[j].set_facecolor("orange")
-            elif trace in yellow_list:
-                fig.axes[j].set_facecolor("yellow")
-            else:
-                fig.axes[j].set_facecolor("#D3D3D3")
-
-        idx = -1
-        max_val = 0
-        for i in range(len(stream)):
-            trace = stream[i]
-            if trace_get_name(trace) in self.POTENTIAL_GLITCHES:  ## won't consider glitches info for NETWORK EPICs
-                continue
-            cur_data = trace.data[-trace.stats.numsamples:]
-            mn = min(cur_data)
-            mx = max(cur_data)
-            best = mn if abs(mn) > abs(mx) else mx
-            if abs(max_val) < abs(best):
-                idx = i
-                max_val = abs(best)
-
-        if self.send_epics:
-            prefix=self.epics_prefix
-            for trace in stream:
-                starter = "STATION_0" + self.pickets[trace.stats.station]['index'] + "_"
-                cur_data = trace.data[-trace.stats.numsamples:]
-                subprocess.Popen(["caput", prefix + starter + "MIN", f"{np.min(cur_data)}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  ## try different min method
-                subprocess.Popen(["caput", prefix + starter + "MAX", f"{np.max(cur_data)}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  ## try different max method
-                subprocess.Popen(["caput", prefix + starter + "MEAN", f"{np.mean(cur_data)}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  ## try different mean method
-            subprocess.Popen(["caput", prefix + "NETWORK_PEAK", f"{max_val}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            subprocess.Popen(["caput", prefix + "NETWORK_STATION_NUM", f"{self.pickets[stream[idx].stats.station]['index']}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            subprocess.Popen(["caput", prefix + "NETWORK_STATION_NAME", f"{stream[idx].stats.station}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            subprocess.Popen(["caput", prefix + "SERVER_GPS", f"{tconvert('now').seconds}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            fig.axes[j].set_facecolor(detectionEngine.colors[levels.get(trace_get_name(trace), 'gray')])
 
         fig.canvas.draw()
 			                
@@ -660,6 +1793,17 @@ def name_get_trace(stream, name):
     return "No trace with that name"
 
 
+def channelToID(channel):
+    #"NET_STA:LOCCHA", the channel of a picket, to the trace id "NET.STA.LOC.CHA"
+    netSta, selector = channel.split(':')
+    network, station = netSta.split('_')
+    return ".".join((network, station, selector[:-3], selector[-3:]))
+
+
+#Function that gives the servers of a picket: its 'PreferredServer' and the optional 'Servers' list, all subscribed at the same time
+def picketServers(statInfo):
+    return list(dict.fromkeys([statInfo['PreferredServer']]+list(statInfo.get('Servers', []))))
+
 def ID_Creator(s):
     return int(''.join(str(format(ord(c), "x")) for c in s), 16)
 
@@ -672,32 +1816,101 @@ def Reverse_ID(n):
         result += chr(int(s[i:i+2], 16))
     return result
 
-def initEpics(picket_dict, prefix): #TODO: Migrate this function to the EPICS server code
-
-    subprocess.Popen(["caput", prefix + "NETWORK_PEAK", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.Popen(["caput", prefix + "NETWORK_STATION_NUM", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.Popen(["caput", prefix + "NETWORK_STATION_NAME", ""], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.Popen(["caput", prefix + "NETWORK_AUX1", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.Popen(["caput", prefix + "NETWORK_AUX2", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    subprocess.Popen(["caput", prefix + "NETWORK_AUX3", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    
+def initEpics(picket_dict, prefix, writer): #TODO: Migrate this function to the EPICS server code
+    values=[(prefix + "NETWORK_PEAK", -1),
+            (prefix + "NETWORK_STATION_NUM", -1),
+            (prefix + "NETWORK_STATION_NAME", ""),
+            (prefix + "NETWORK_AUX1", -1),
+            (prefix + "NETWORK_AUX2", -1),
+            (prefix + "NETWORK_AUX3", -1)]
     for statName, statInfo in picket_dict.items():
-                starter = "STATION_0" + statInfo['index'] + "_"
-                subprocess.Popen(["caput", prefix + starter + "LAT", str(statInfo['Latitude'])], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "LON", str(statInfo['Longitude'])], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "MIN", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "MAX", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "MEAN", "-1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "ID", f"{ID_Creator(statName)}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                subprocess.Popen(["caput", prefix + starter + "NAME", f"{statName}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)           
-    subprocess.Popen(["caput", prefix + "SERVER_GPS", f"{tconvert('now').seconds}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        starter = stationPrefix(statInfo['index'])
+        values += [(prefix + starter + "LAT", statInfo['Latitude']),
+                   (prefix + starter + "LON", statInfo['Longitude']),
+                   (prefix + starter + "MIN", -1),
+                   (prefix + starter + "MAX", -1),
+                   (prefix + starter + "MEAN", -1),
+                   (prefix + starter + "LATENCY", -1),
+                   (prefix + starter + "LATENCY_P95", -1),
+                   (prefix + starter + "GAPS", 0),
+                   (prefix + starter + "ID", ID_Creator(statName)),
+                   (prefix + starter + "NAME", statName)]
+    values.append((prefix + "SERVER_GPS", tconvert('now').seconds))
+    writer.putMany(values)
     
 
 #def updateEpics(picket_dict, prefix, updateMetadata):
 
+#Function that creates the associationEngine of the pickets, None if the association is off
+def createAssociator(picket_dict, myargs):
+    if not myargs.association:
+        return None
+    grid=None
+    if myargs.observatory is not None:  ## the events are located and their arrival at the observatory is predicted
+        grid=travelTimeGrid(picket_dict, myargs.observatory, prefix=myargs.traveltime_file)
+    return associationEngine(picket_dict, observatory=myargs.observatory, min_stations=myargs.association_stations,
+                             tolerance=myargs.association_tolerance, grid=grid)
+
+class connectionSupervisor():
+    """
+    Keeps the connection to one SeedLink server alive.
+
+    The client runs on the supervisor thread, so a lost connection is noticed as soon as the client returns. Only that
+    client is created again (see PicketFence.createClient), resuming from the sequence numbers of the last packets, after
+    a delay that doubles with every failure in a row up to 'max_backoff' seconds. A connection that stayed up for
+    'stable_time' seconds resets the delay.
+    """
+    def __init__(self, server_name, channels, createClient, min_backoff=1, max_backoff=300, stable_time=60, clock=None):
+        self.server_name=server_name
+        self.channels=channels
+        self.createClient=createClient
+        self.min_backoff=min_backoff
+        self.max_backoff=max_backoff
+        self.stable_time=stable_time
+        self.client=None
+        self.statistics=feedStatistics(server_name, clock=clock)   # latency of the packets, kept across connections
+        self.failures=0         # connections lost in a row
+        self.sequence=dict()    # (network, station) -> (sequence number, time) of the last packet, to resume from it
+        self.stop_event=threading.Event()
+        self.thread=None
+
+    def start(self):
+        self.thread=threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.client is not None:
+            self.client.stop_flag=True
+
+    def run(self):
+        backoff=self.min_backoff
+        while not self.stop_event.is_set():
+            start=perf_counter()
+            try:
+                self.client=self.createClient(self.server_name, self.channels, self.sequence)
+                self.client.statistics=self.statistics
+                self.statistics.connected()
+                self.client.run()
+            except Exception as e:
+                logging.error("%s: %s" % (self.server_name, e))
+            if self.client is not None:
+                self.sequence.update({(stream.net, stream.station):(stream.seqnum, stream.btime)
+                                      for stream in self.client.slconn.get_streams() if stream.seqnum!=-1})
+            if self.stop_event.is_set():
+                break
+            if perf_counter()-start>self.stable_time:
+                backoff=self.min_backoff
+            self.failures+=1
+            print('Connection lost with server:  ', self.server_name, ', reconnecting in %d s' % backoff)
+            self.stop_event.wait(backoff)
+            backoff=min(2*backoff, self.max_backoff)
+
+
 class PicketFence():
-    def __init__(self, picket_dict, myargs, epics_prefix):
+    def __init__(self, picket_dict, myargs, epics_prefix, clock=None):
         self.args=myargs
+        self.clock=realClock() if clock is None else clock
         self.pickets=picket_dict
         self.stop_flag = False
         self.leave = [False]
@@ -706,71 +1919,196 @@ class PicketFence():
         if self.send_epics:
             assert type(epics_prefix) == str , "the epics prefix should be a string"
         self.args.epics_prefix=epics_prefix
+        self.writer = createWriter(self.args.epics_backend, prefix=epics_prefix, picket_dict=picket_dict) if self.send_epics else None
 
     def run(self):
-        while self.leave[0]==False:
-            self.startnow = UTCDateTime()
-            self.stream = Stream()
-            self.events = Catalog()
-            self.lock = threading.Lock()
-    
-            if self.args.send_epics:  ## will initialize the EPICs variables
-                initEpics(self.pickets,self.epics_prefix)
-            
-            #create the strings to request stations from the server. They will be stored by server name
-            server_dict=dict()
-            for statName in self.pickets.keys():
-                server_name=self.pickets[statName]['PreferredServer'];
+        #the buffers and filter states are kept when a connection is restarted
+        self.lock = threading.Lock()
+        self.stream = ringBufferStream(buffer_time=self.args.stream_time, clock=self.clock)
+        self.filtStream=filteredStream(self.stream, myargs=self.args, clock=self.clock)
+        if self.args.checkpoint_file is not None:
+            restored=self.filtStream.loadCheckpoint(self.args.checkpoint_file, self.clock.now())
+            if restored:
+                print('Restored from checkpoint:  ', ', '.join(restored))
+            self.checkpoint_stop=threading.Event()
+            threading.Thread(target=self.checkpointer, daemon=True).start()
+
+        self.startnow = self.clock.now()
+        self.monitor = latencyMonitor(self.clock)
+        self.events = Catalog()
+        if self.args.send_epics:  ## will initialize the EPICs variables
+            initEpics(self.pickets,self.epics_prefix,self.writer)
+        
+        #create the strings to request stations from the server. They will be stored by server name
+        #a picket with several servers is requested from all of them, the buffers keep the first copy of each packet
+        server_dict=dict()
+        for statName in self.pickets.keys():
+            for server_name in picketServers(self.pickets[statName]):
                 if server_name not in server_dict.keys(): #server not listed
                     server_dict[server_name]=self.pickets[statName]['Channel']
                 else: #server has been listed
-                    server_dict[server_name]=server_dict[server_name]+', ' + self.pickets[statName]['Channel']              
-            self.server_dict=server_dict
-        
-            #Create a list of seedlink clients that will be watched
-            self.seedlink_clients=[]
-        
-            ii=0
-            for server_name in server_dict.keys():
-                self.seedlink_clients.append(SeedlinkUpdater(self.stream, myargs=self.args, lock=self.lock))
-                self.seedlink_clients[ii].slconn.set_sl_address(server_name)
-                self.seedlink_clients[ii].multiselect = server_dict[server_name]
-                self.seedlink_clients[ii].begin_time = (self.startnow - 2000).format_seedlink() #TODO make it not 2000 seconds flat
-                self.seedlink_clients[ii].initialize()
-                print('Downloading from server:  ', server_name)
-                print(server_dict[server_name])
-                ii+=1
-            
-            #Create the filtered stream and the plotter
-            self.filtStream=filteredStream(self.stream, myargs=self.args)  
-            self.master = SeedlinkPlotter(stream=self.filtStream, picket_dict=self.pickets, events=self.events, myargs=self.args, lock=self.lock, leave=self.leave) #, send_epics=args.epics)
-        
-            #Monitor the connections to seedlink
-            self.watchers=[threading.Thread(target=self.watcher, args=(client.run,), daemon=True) for client in self.seedlink_clients] ## threads to monitor the connection with IRIS
-        
-            for watching_thread in self.watchers:
-                watching_thread.start()
-            sleep(3)
+                    server_dict[server_name]=server_dict[server_name]+', ' + self.pickets[statName]['Channel']
+        self.server_dict=server_dict
+        for statInfo in self.pickets.values():
+            if len(picketServers(statInfo))>1:
+                self.stream.gapHold[channelToID(statInfo['Channel'])]=self.args.gap_grace
+    
+        #Create the detection engine that analyzes the filtered stream, the clients hand it every packet with packet_detection
+        self.associator=createAssociator(self.pickets, self.args)
+        self.engine=detectionEngine(self.filtStream, picket_dict=self.pickets, myargs=self.args, lock=self.lock, writer=self.writer, clock=self.clock,
+                                    associator=self.associator)
+        self.detector=packetDetector(self.filtStream, self.engine, self.lock) if self.args.packet_detection else None
+
+        #One supervisor per server, each one reconnects its own client when it fails
+        self.supervisors=[connectionSupervisor(server_name, server_dict[server_name], self.createClient, clock=self.clock) for server_name in server_dict.keys()]
+        for supervisor in self.supervisors:
+            supervisor.start()
+        self.report_stop=threading.Event()
+        if self.args.feed_report_interval>0:
+            threading.Thread(target=self.feedReporter, daemon=True).start()
+        if self.args.latency_interval>0:
+            threading.Thread(target=self.latencyReporter, daemon=True).start()
+        if hasattr(signal_module, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal_module.signal(signal_module.SIGUSR1, lambda signum, frame: self.requestProfile())
+        self.metrics=None
+        if self.args.metrics_port is not None:
+            self.metrics=metricsServer(self.args.metrics_port, self.metricsSources())
+            self.metrics.start()
+
+        sleep(3)
+        self.engine.start()
 
+        if self.args.headless:
+            try:
+                while not self.leave[0]:
+                    sleep(1)  ## main thread waits until it is interrupted
+            except KeyboardInterrupt:
+                self.leave=[True]
+        else:
+            self.master = SeedlinkPlotter(stream=self.filtStream, picket_dict=self.pickets, events=self.events, myargs=self.args, lock=self.lock, leave=self.leave, engine=self.engine, clock=self.clock) #, send_epics=args.epics)
             self.master.mainloop()  ## main thread is now creating the display
             self.leave=self.master.leave;
             self.master.destroy()  ## mainloop was exited, now destroying master
-            if self.leave[0]:
-                return
-            for watching_thread in self.watchers:
-                watching_thread.join() ## ensures all threads are cleaned before restarting
+        self.engine.stop()
+        for supervisor in self.supervisors:
+            supervisor.stop()
+        self.report_stop.set()
+        if self.args.feed_report_interval>0:
+            self.feedReport()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.args.checkpoint_file is not None:
+            self.checkpoint_stop.set()
+            self.saveCheckpoint()
+
+    #Function that creates a SeedlinkUpdater for a server, requesting the data that the buffers are missing.
+    #When the buffers have data of all the channels, the server is asked to continue after the last packets that were
+    #received ('sequence' of the previous connection, or the state file), so nothing is downloaded twice
+    def createClient(self, server_name, channels, sequence=None):
+        self.startnow = self.clock.now()
+        client=SeedlinkUpdater(self.stream, myargs=self.args, lock=self.lock, monitor=self.monitor, detector=self.detector)
+        client.slconn.set_sl_address(server_name)
+        client.multiselect = channels
+        begin_time = self.beginTime(channels)
+        client.begin_time = begin_time.format_seedlink()
+        if self.args.statefile_prefix is not None:
+            client.statefile = self.args.statefile_prefix + "." + server_name.replace(':', '_')
+        client.initialize()
+        resume = begin_time > self.startnow - self.backfillTime()
+        for stream in client.slconn.get_streams():
+            if not resume:
+                stream.seqnum = -1  ## the buffers are missing data, start from begin_time
+            elif sequence and (stream.net, stream.station) in sequence:
+                stream.seqnum, stream.btime = sequence[(stream.net, stream.station)]
+        print('Downloading from server:  ', server_name)
+        print(channels)
+        return client
+
+    #Function that gives how much data the picket fence needs at start: the start of the filter plus the displayed time
+    def backfillTime(self):
+        return self.filtStream.startupTime + self.args.backtrace_time
+
+    #Function that gives the start of the data to request for the channels of a server: where the buffers end if they
+    #have data of all of them (so only the missing interval is downloaded), backfillTime() ago otherwise
+    def beginTime(self, channels):
+        backfill=self.startnow-self.backfillTime()
+        endtimes=[]
+        for channel in channels.split(','):
+            trace_id=channelToID(channel.strip())
+            if trace_id not in self.stream.buffers or self.stream.getEndtime(trace_id) is None:
+                return backfill
+            endtimes.append(self.stream.getEndtime(trace_id))
+        return max(min(endtimes), backfill)
+
+    def saveCheckpoint(self):
+        try:
+            with self.lock:
+                arrays=self.filtStream.getCheckpoint()
+            self.filtStream.saveCheckpoint(self.args.checkpoint_file, arrays)
+        except Exception as e:
+            logging.error("could not save the checkpoint: %s" % e)
+
+    def checkpointer(self):
+        while not self.checkpoint_stop.wait(self.args.checkpoint_interval):
+            self.saveCheckpoint()
+
+    #Function that prints the latency of every server, to compare the feeds of the pickets that have several
+    def feedReport(self):
+        for supervisor in self.supervisors:
+            print('Feed:  ', supervisor.statistics.summary())
+
+    def feedReporter(self):
+        while not self.report_stop.wait(self.args.feed_report_interval):
+            self.feedReport()
+
+    #Function that prints the latency of the data of every station and writes it into EPICS
+    def latencyReporter(self):
+        while not self.report_stop.wait(self.args.latency_interval):
+            summary=self.monitor.summary()
+            print(self.monitor.logLine(summary))
+            if self.send_epics:
+                try:
+                    self.publishLatency(summary)
+                except Exception as e:
+                    logging.error(e)
+
+    def publishLatency(self, summary):
+        values=[]
+        for statInfo in self.pickets.values():
+            starter=self.epics_prefix + stationPrefix(statInfo['index'])
+            station=summary.get(channelToID(statInfo['Channel']))
+            if station is None or station['latency_p50'] is None:
+                values += [(starter + "LATENCY", -1), (starter + "LATENCY_P95", -1)]
+            else:
+                values += [(starter + "LATENCY", station['latency_p50']), (starter + "LATENCY_P95", station['latency_p95'])]
+            values.append((starter + "GAPS", station['gaps'] if station is not None else 0))
+        self.writer.putMany(values)
+
+    #Sections of the JSON served on the metrics port
+    def metricsSources(self):
+        return {'time': lambda: str(self.clock.now()),
+                'stations': self.monitor.summary,
+                'servers': lambda: {supervisor.server_name: dict(supervisor.statistics.metrics(), failures=supervisor.failures)
+                                    for supervisor in self.supervisors},
+                'timing': lambda: {timer.name: timer.summary() for timer in self.timers()},
+                'startup': self.startupMetrics,
+                'packet_detection': lambda: self.detector.metrics() if self.detector is not None else None,
+                'association': lambda: self.associator.metrics() if self.associator is not None else None}
+
+    def startupMetrics(self):
+        with self.lock:
+            return self.filtStream.startupMetrics()
+
+    #Stage timers of the detection and of the display
+    def timers(self):
+        timers=[self.engine.timer] if hasattr(self, 'engine') else []
+        if hasattr(self, 'master'):
+            timers.append(self.master.timer)
+        return timers
+
+    #Function that profiles the next cycles of the detection and of the display (signal SIGUSR1)
+    def requestProfile(self):
+        for timer in self.timers():
+            timer.requestProfile()
         
     
-    def watcher(self,function):
-        thread = threading.Thread(target=function, daemon=True)
-        thread.start()
-        while True:
-            sleep(20)  ## possible that this pings too often. Maybe exponential with some MAX?? (ASK EDGARD)
-            if not thread.is_alive():  ## connection lost
-                ## these are probably unnecessary
-                self.stop_flag = True  ## killing thread (I am basically resetting the entire main function with this)
-                for client in self.seedlink_clients:
-                    client.stop_flag=True
-                thread.join()
-                self.master.quit()  ## letting main thread break out of mainloop
-                break  ## allowing watching_conn to leave scope (terminating)
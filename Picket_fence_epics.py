@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EPICS output for the picket fence.
+
+The picket fence writes its results into the PVs served by LHO-Server.py/LLO-Server.py. A writer object hides how the
+values get there:
+-- caEpicsWriter: keeps one persistent Channel Access channel per PV (pyepics) and sends all the puts of an update
+   before flushing the CA buffer once.
+-- caputWriter: forks one `caput` process per PV, this is what the picket fence always did and is kept as a fallback
+   for hosts without pyepics.
+-- pcaspyWriter: the picket fence hosts the IOC itself (embeddedIOC, the same pcaspy SimpleServer as LHO-Server.py)
+   and writes the values straight into its driver, there is no Channel Access round trip at all.
+
+Running this file measures how many puts per second each writer can do against a running IOC, e.g.
+    python3 Picket_fence_epics.py --prefix H1:SEI-USGS_ --backend pyepics
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import subprocess
+import threading
+import logging
+import time
+
+try:
+    import epics
+except ImportError:
+    epics = None
+try:
+    from pcaspy import Driver, SimpleServer
+except ImportError:
+    Driver = object
+    SimpleServer = None
+
+
+def stationPrefix(index):
+    #name of the PVs of a station, it has to match the database in LHO-Server.py/LLO-Server.py
+    index = int(index)
+    return f"STATION_0{index}_" if index < 10 else f"STATION_{index}_"
+
+
+class caputWriter():
+    """
+    Writes every value with its own `caput` process.
+    """
+    def __init__(self):
+        self.processes = []
+
+    def put(self, pvname, value):
+        self.putMany([(pvname, value)])
+
+    def putMany(self, values):
+        #values is a list of (pvname, value)
+        self.reap()
+        for pvname, value in values:
+            self.processes.append(subprocess.Popen(["caput", pvname, f"{value}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def reap(self):
+        #collect the processes that already finished so that they do not pile up as zombies
+        self.processes = [process for process in self.processes if process.poll() is None]
+
+    def flush(self):
+        for process in self.processes:
+            process.wait()
+        self.processes = []
+
+    def close(self):
+        self.flush()
+
+
+class caEpicsWriter():
+    """
+    Writes values through persistent Channel Access channels (pyepics).
+
+    The channel of a PV is created the first time it is written and reused afterwards. The new channels of a putMany()
+    are created together and waited for once, at most 'connection_timeout' seconds for all of them, so a missing IOC
+    does not stall the caller for every PV. Puts do not wait for the IOC, the CA buffer is flushed once per putMany().
+    Values for PVs that are not connected (yet) are dropped, pyepics keeps trying to connect them in the background.
+    """
+    def __init__(self, connection_timeout=1.0):
+        if epics is None:
+            raise ImportError("pyepics is needed for the 'pyepics' EPICS backend")
+        self.connection_timeout = connection_timeout
+        self.pvs = dict()
+
+    def connect(self, pvnames):
+        #creates the channels of the PVs that have none yet, then waits for them with one shared timeout
+        new = []
+        for pvname in pvnames:
+            if pvname not in self.pvs:
+                self.pvs[pvname] = epics.PV(pvname, auto_monitor=False, connection_timeout=self.connection_timeout)
+                new.append(self.pvs[pvname])
+        deadline = time.monotonic() + self.connection_timeout
+        for pv in new:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            pv.wait_for_connection(timeout=remaining)
+
+    def put(self, pvname, value):
+        self.putMany([(pvname, value)])
+
+    def putMany(self, values):
+        self.connect([pvname for pvname, value in values])
+        for pvname, value in values:
+            pv = self.pvs[pvname]
+            if not pv.connected:
+                logging.debug("EPICS channel %s is not connected, value dropped" % pvname)
+                continue
+            pv.put(value, wait=False)
+        epics.ca.flush_io()
+
+    def flush(self):
+        epics.ca.flush_io()
+
+    def close(self):
+        for pv in self.pvs.values():
+            pv.disconnect()
+        self.pvs = dict()
+
+
+def createPVDatabase(picket_dict):
+    #PV database of the picket fence, the same as the one of LHO-Server.py/LLO-Server.py but with one set of station PVs per picket
+    pvdb = dict()
+    for statInfo in picket_dict.values():
+        starter = stationPrefix(statInfo['index'])
+        pvdb[starter + "LON"] = {'prec' : 3}  ## longitude
+        pvdb[starter + "LAT"] = {'prec' : 3}  ## latitude
+        pvdb[starter + "MIN"] = {'prec' : 3}  ## min value of station
+        pvdb[starter + "MAX"] = {'prec' : 3}  ## max value of station
+        pvdb[starter + "MEAN"] = {'prec' : 3}  ## mean value of station
+        pvdb[starter + "LATENCY"] = {'prec' : 1}  ## median latency (s) of the data of station
+        pvdb[starter + "LATENCY_P95"] = {'prec' : 1}  ## 95th percentile of the latency (s) of station
+        pvdb[starter + "GAPS"] = {'type' : 'int'}  ## gaps in the data of station
+        pvdb[starter + "ID"] = {'type' : 'int'}  ## hex value of string
+        pvdb[starter + "NAME"] = {'type' : 'str'}  ## string version of ID
+    pvdb["NETWORK_PEAK"] = {'type' : 'int'}  ## max absolute value from all stations
+    pvdb["NETWORK_STATION_NUM"] = {'type' : 'int'}  ## which station the max came from
+    pvdb["NETWORK_STATION_NAME"] = {'type' : 'str'}  ## which station the max came from
+    pvdb["NETWORK_AUX1"] = {'type' : 'int'}  ## currently being used to document glitches
+    pvdb["NETWORK_AUX2"] = {'type' : 'int'}  ## GPS time of the arrival of the located earthquake at the site
+    pvdb["NETWORK_AUX3"] = {'type' : 'int'}  ## seconds until that arrival (lead time)
+    #heartbeat to check the uptime of the picket fence code
+    pvdb["SERVER_START_GPS"] = {'type' : 'int'}
+    pvdb["SERVER_GPS"] = {'type' : 'int'}
+    return pvdb
+
+
+class picketFenceDriver(Driver):
+    def __init__(self):
+        super(picketFenceDriver, self).__init__()
+
+
+class embeddedIOC():
+    """
+    pcaspy IOC that runs inside the picket fence process, on a background thread.
+
+    It serves the same PVs as LHO-Server.py/LLO-Server.py, so it replaces that server: do not run both with the same prefix.
+    """
+    def __init__(self, prefix, picket_dict):
+        if SimpleServer is None:
+            raise ImportError("pcaspy is needed for the 'pcaspy' EPICS backend")
+        from gwpy.time import tconvert
+        self.prefix = prefix
+        self.server = SimpleServer()
+        self.server.createPV(prefix, createPVDatabase(picket_dict))
+        self.driver = picketFenceDriver()
+        for name in ("NETWORK_PEAK", "NETWORK_STATION_NUM", "NETWORK_AUX1", "NETWORK_AUX2", "NETWORK_AUX3"):
+            self.driver.setParam(name, -1)
+        self.driver.setParam("NETWORK_STATION_NAME", "")
+        self.driver.setParam("SERVER_START_GPS", tconvert("now").seconds)
+        self.driver.setParam("SERVER_GPS", tconvert("now").seconds)
+        self.driver.updatePVs()
+        self.stop_flag = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # process CA transactions
+        while not self.stop_flag:
+            self.server.process(0.1)
+
+    def stop(self):
+        self.stop_flag = True
+        if self.thread is not None:
+            self.thread.join()
+
+
+class pcaspyWriter():
+    """
+    Writes values straight into the driver of an embeddedIOC, clients are notified once per putMany().
+    """
+    def __init__(self, ioc):
+        self.ioc = ioc
+        self.lock = threading.Lock()
+
+    def put(self, pvname, value):
+        self.putMany([(pvname, value)])
+
+    def putMany(self, values):
+        prefix = self.ioc.prefix
+        with self.lock:
+            for pvname, value in values:
+                reason = pvname[len(prefix):] if pvname.startswith(prefix) else pvname
+                self.ioc.driver.setParam(reason, value)
+            self.ioc.driver.updatePVs()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.ioc.stop()
+
+
+def createWriter(backend='auto', prefix=None, picket_dict=None):
+    #'auto' uses pyepics when it is installed and falls back to caput otherwise,
+    #'pcaspy' starts an embeddedIOC with the PVs of the pickets in picket_dict
+    if backend == 'auto':
+        backend = 'pyepics' if epics is not None else 'caput'
+    if backend == 'pyepics':
+        return caEpicsWriter()
+    if backend == 'caput':
+        return caputWriter()
+    if backend == 'pcaspy':
+        ioc = embeddedIOC(prefix, picket_dict)
+        ioc.start()
+        return pcaspyWriter(ioc)
+    raise ValueError("unknown EPICS backend: %s" % backend)
+
+
+def benchmarkWriter(writer, pvnames, rounds=100):
+    #writes every PV 'rounds' times in batches like the picket fence does, returns the number of puts per second
+    start = time.perf_counter()
+    for ii in range(rounds):
+        writer.putMany([(pvname, ii) for pvname in pvnames])
+    writer.flush()
+    return rounds * len(pvnames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = ArgumentParser(prog='Picket_fence_epics',
+                            description='Measure the EPICS puts per second of the picket fence writers',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--prefix', default='H1:SEI-USGS_', help='prefix of the PVs served by the IOC')
+    parser.add_argument('--backend', default='all', choices=['all', 'pyepics', 'caput', 'pcaspy'],
+                        help="writer to measure, 'pcaspy' starts its own IOC with the prefix")
+    parser.add_argument('--stations', default=6, type=int, help='number of stations in the IOC')
+    parser.add_argument('--rounds', default=20, type=int, help='number of updates of all the PVs')
+    args = parser.parse_args()
+
+    #the PVs that change on every update of the picket fence
+    pvnames = [args.prefix + stationPrefix(ii) + field for ii in range(1, args.stations + 1) for field in ("MIN", "MAX", "MEAN")]
+    pvnames += [args.prefix + name for name in ("NETWORK_PEAK", "NETWORK_STATION_NUM", "SERVER_GPS")]
+
+    pickets = {str(ii): {'index': str(ii)} for ii in range(1, args.stations + 1)}
+    backends = ['pyepics', 'caput', 'pcaspy'] if args.backend == 'all' else [args.backend]
+    for backend in backends:
+        try:
+            writer = createWriter(backend, prefix=args.prefix, picket_dict=pickets)
+        except ImportError as e:
+            print(f"{backend}: skipped ({e})")
+            continue
+        rate = benchmarkWriter(writer, pvnames, rounds=args.rounds)
+        writer.close()
+        print(f"{backend}: {rate:.0f} puts/s ({len(pvnames)} PVs per update)")
+
+
+if __name__ == '__main__':
+    main()
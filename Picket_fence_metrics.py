@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Data latency of the picket fence.
+
+Every packet handed to SeedlinkUpdater.handleTrace() is recorded by a latencyMonitor: the time of its arrival against
+the time of its last sample. Each station keeps the packets of the last 'window' seconds, from which the median, 95th
+percentile and maximum latency and the packets written per second are computed, and counts the gaps of its data. The
+packets of the backfill that is downloaded when a connection opens are counted but do not enter the latency, those
+resumed after a reconnection enter the packets per second.
+
+The numbers are printed by the picket fence, written to the STATION_xx_LATENCY/LATENCY_P95/GAPS EPICS variables and,
+with a metrics port, served as JSON by a metricsServer, e.g.
+    curl http://localhost:8000/metrics
+
+The cycles of the detection and of the display are timed stage by stage with a stageTimer, which reports the cycles that
+take longer than the update time and can run cProfile over the next cycles when it is asked to (key 'p' or SIGUSR1).
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import threading
+import logging
+import cProfile
+import pstats
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+
+class stationLatency():
+    """
+    Latency and gaps of the packets of one channel.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.arrivals = deque()     # (arrival timestamp, latency in seconds) of the live packets of the last 'window' seconds
+        self.writes = deque()       # arrival timestamps of the packets of the last 'window' seconds that wrote samples
+        self.endtime = None         # time of the last sample written to the buffers
+        self.since = None           # arrival timestamp of the first live packet
+        self.packets = 0            # packets received, including the backfill and the copies from other servers
+        self.gaps = 0               # gaps between the packets written to the buffers
+
+    def record(self, arrival, trace, written, live=True, gaps=None):
+        #'gaps' is the number of gaps interpolated in the buffer of the channel, None counts them between the packets
+        stats = trace.stats
+        self.packets += 1
+        if gaps is not None:
+            self.gaps = gaps
+        if written > 0:
+            if gaps is None and self.endtime is not None and stats.starttime - self.endtime > 1.5 * stats.delta:
+                self.gaps += 1
+            if self.endtime is None or stats.endtime > self.endtime:
+                self.endtime = stats.endtime
+        if live:
+            if self.since is None:
+                self.since = arrival.timestamp
+            self.arrivals.append((arrival.timestamp, arrival - stats.endtime))
+        #the rate counts every packet written since the first live one, also the packets resumed after a reconnection
+        #(they are not live), but not the initial backfill nor the copies from other servers
+        if written > 0 and self.since is not None:
+            self.writes.append(arrival.timestamp)
+        self.expire(arrival.timestamp)
+
+    def expire(self, now):
+        while self.arrivals and self.arrivals[0][0] < now - self.window:
+            self.arrivals.popleft()
+        while self.writes and self.writes[0] < now - self.window:
+            self.writes.popleft()
+
+    def summary(self, now):
+        #statistics of the last 'window' seconds, the latencies are None without live packets
+        self.expire(now.timestamp)
+        span = min(self.window, now.timestamp - self.since) if self.since is not None else 0
+        summary = {'packets': self.packets, 'gaps': self.gaps, 'rate': len(self.writes) / span if span > 0 else 0.0,
+                   'latency_p50': None, 'latency_p95': None, 'latency_max': None,
+                   'age': now - self.endtime if self.endtime is not None else None}
+        if self.arrivals:
+            latencies = np.array([latency for arrival, latency in self.arrivals])
+            summary.update({'latency_p50': float(np.median(latencies)), 'latency_p95': float(np.percentile(latencies, 95)),
+                            'latency_max': float(latencies.max())})
+        return summary
+
+
+class latencyMonitor():
+    """
+    One stationLatency per trace id, shared by all the SeedLink clients of the picket fence.
+    """
+    def __init__(self, clock, window=600):
+        self.clock = clock
+        self.window = window
+        self.stations = dict()
+        self.lock = threading.Lock()
+
+    def record(self, trace, written, live=True, gaps=None):
+        arrival = self.clock.now()
+        with self.lock:
+            station = self.stations.get(trace.id)
+            if station is None:
+                station = self.stations[trace.id] = stationLatency(self.window)
+            station.record(arrival, trace, written, live, gaps)
+
+    def summary(self):
+        now = self.clock.now()
+        with self.lock:
+            return {trace_id: station.summary(now) for trace_id, station in sorted(self.stations.items())}
+
+    def logLine(self, summary=None):
+        #one line with the latency of every station, e.g. "HLID 0.9/1.4 s 0.1 pkt/s 0 gaps"
+        summary = self.summary() if summary is None else summary
+        parts = []
+        for trace_id, values in summary.items():
+            latency = "-" if values['latency_p50'] is None else "%.1f/%.1f s" % (values['latency_p50'], values['latency_p95'])
+            parts.append("%s %s %.2f pkt/s %d gaps" % (trace_id.split('.')[1], latency, values['rate'], values['gaps']))
+        return "latency (median/95%): " + ", ".join(parts)
+
+
+def rollingStats(values):
+    values = np.array(values)
+    return {'mean': float(values.mean()), 'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+
+class stageTimer():
+    """
+    Duration of every stage of a cycle that should take less than 'budget' seconds, e.g.
+        timer.begin()
+        with timer.stage('filter'):
+            ...
+        timer.end()
+    The last 'length' cycles are kept for the statistics. The cycles over the budget are printed at most once every
+    'report_interval' seconds, with the stages of the slowest one. requestProfile() runs cProfile over the next cycles
+    (on the thread of the cycle) and saves the profile to '<prefix>_<name>_<time>.prof', which can be read with
+    pstats or turned into a flame graph with tools such as snakeviz or flameprof.
+    """
+    def __init__(self, name, budget, length=300, report_interval=60, prefix='picket_fence'):
+        self.name = name
+        self.budget = budget
+        self.report_interval = report_interval
+        self.prefix = prefix
+        self.totals = deque(maxlen=length)     # duration of the last cycles
+        self.stages = dict()                    # stage name -> deque with its duration in the last cycles
+        self.length = length
+        self.current = None                     # stage name -> duration in the cycle being timed
+        self.cycleStart = None
+        self.cycles = 0
+        self.overruns = 0
+        self.pendingOverruns = 0                # overruns not printed yet
+        self.worst = None                       # (total, stages) of the slowest cycle not printed yet
+        self.lastReport = time.perf_counter()
+        self.profileCycles = 0                  # cycles still to profile
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def begin(self):
+        if self.profileCycles > 0 and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.current = dict()
+        self.cycleStart = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                self.current[name] = self.current.get(name, 0.0) + time.perf_counter() - start
+
+    def end(self):
+        if self.current is None:
+            return
+        total = time.perf_counter() - self.cycleStart
+        with self.lock:
+            self.cycles += 1
+            self.totals.append(total)
+            for name, duration in self.current.items():
+                self.stages.setdefault(name, deque(maxlen=self.length)).append(duration)
+            if total > self.budget:
+                self.overruns += 1
+                self.pendingOverruns += 1
+                if self.worst is None or total > self.worst[0]:
+                    self.worst = (total, self.current)
+        self.current = None
+        if self.profiler is not None:
+            self.profileCycles -= 1
+            if self.profileCycles <= 0:
+                self.saveProfile()
+        if self.pendingOverruns and time.perf_counter() - self.lastReport > self.report_interval:
+            self.reportOverruns()
+
+    def reportOverruns(self):
+        total, stages = self.worst
+        print("%s: %d cycles over the budget of %g s, the slowest took %.2f s (%s)" % (self.name, self.pendingOverruns,
+              self.budget, total, ", ".join("%s %.2f s" % item for item in stages.items())))
+        self.pendingOverruns = 0
+        self.worst = None
+        self.lastReport = time.perf_counter()
+
+    def requestProfile(self, cycles=10):
+        #can be called from any thread, the profile starts with the next cycle
+        self.profileCycles = cycles
+
+    def saveProfile(self):
+        self.profiler.disable()
+        filename = "%s_%s_%s.prof" % (self.prefix, self.name, time.strftime("%Y%m%d_%H%M%S"))
+        try:
+            self.profiler.dump_stats(filename)
+            print("%s: profile saved to %s" % (self.name, filename))
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(15)
+        except Exception as e:
+            logging.error("%s: could not save the profile: %s" % (self.name, e))
+        self.profiler = None
+        self.profileCycles = 0
+
+    def summary(self):
+        with self.lock:
+            if not self.totals:
+                return {'cycles': 0}
+            return {'cycles': self.cycles, 'overruns': self.overruns, 'budget': self.budget,
+                    'total': rollingStats(self.totals),
+                    'stages': {name: rollingStats(durations) for name, durations in self.stages.items()}}
+
+
+class metricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = json.dumps({name: source() for name, source in self.server.sources.items()}, default=str).encode()
+        except Exception as e:
+            logging.error("metrics: %s" % e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format % args)
+
+
+class metricsServer(ThreadingHTTPServer):
+    """
+    Serves the metrics of the picket fence as JSON on a background thread.
+
+    'sources' maps the name of every section of the answer to a function that returns its content.
+    """
+    daemon_threads = True
+
+    def __init__(self, port, sources, host='localhost'):
+        super(metricsServer, self).__init__((host, port), metricsHandler)
+        self.sources = sources
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
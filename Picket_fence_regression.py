@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Golden-data regression check of the filter and the detection of the picket fence.
+
+A few scenarios of synthetic waveforms (a quiet network, an earthquake that crosses the network, a glitch, a gap) or
+miniSEED files are replayed through the picket fence (Picket_fence_replay). The filtered data of every channel and
+the level transitions of every station are saved with --record, by default with the lsim engine of the original
+pipeline, and --check runs them again, by default with the engine of the picket fence (sos), and compares:
+-- the filtered data: the largest difference relative to the largest golden value, per channel, must stay within
+   --tolerance. The sos engine restarts like lsim and is only used for a sample rate where it matches lsim within
+   1e-6 (filteredStream.getSOS), so the default tolerance is the same
+-- the decisions: the station level transitions (gray/yellow/orange/red/glitch, with their times) must be the same
+-- the speed: the replay and filter times of the checked engine next to those of the engine of the golden data,
+   measured in the same run
+-- the filter states: with channels that get packets of different lengths, not in lockstep, the saved filter state of
+   every channel must stay within one packet of its data, or the backlog is filtered again on every cycle
+-- the gaps: a channel downloaded from two servers, where the first one misses packets and the second one sends them
+   a few seconds later, must be left with the real samples, and only the packet that never arrives interpolated
+e.g.
+    python3 Picket_fence_regression.py --record golden.npz
+    python3 Picket_fence_regression.py --check golden.npz
+The exit code is 1 when a check fails.
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import glob
+import json
+import sys
+import os
+
+import numpy as np
+from obspy import Trace, UTCDateTime, read
+
+from Picket_fence_code_v2 import picketFenceArguments, channelToID, ringBufferStream, filteredStream, simulatedClock
+from Picket_fence_replay import picketFenceReplay, readArchive
+
+SCENARIO_START = UTCDateTime(2024, 1, 1)
+SCENARIO_LENGTH = 2700          # seconds, the backfill of the replay and 27 minutes of detection
+
+#synthetic network: station -> (channel, sampling rate, arrival delay of the earthquake in seconds, earthquake amplitude)
+SYNTHETIC_STATIONS = {
+    "AAA": ("XX_AAA:00BHZ", 40.0, 0, 400000.0),
+    "BBB": ("XX_BBB:00BHZ", 40.0, 25, 60000.0),
+    "CCC": ("XX_CCC:HHZ", 100.0, 40, 15000.0),
+    "DDD": ("XX_DDD:HHZ", 100.0, 70, 3000.0),
+}
+
+
+def syntheticPickets():
+    pickets = dict()
+    for index, (station, (channel, sampling_rate, delay, amplitude)) in enumerate(SYNTHETIC_STATIONS.items()):
+        pickets[station] = {"Latitude": 0.0, "Longitude": 0.0, "Channel": channel, "PreferredServer": "", "index": str(index + 1)}
+    return pickets
+
+
+def noise(rng, npts, sampling_rate):
+    #background noise and microseism, in counts
+    t = np.arange(npts) / sampling_rate
+    return 30.0 * rng.standard_normal(npts) + 200.0 * np.sin(2 * np.pi * 0.15 * t + rng.uniform(0, 2 * np.pi))
+
+
+def earthquake(npts, sampling_rate, onset, amplitude):
+    #a surface wave train: 20 s period, decaying over a few minutes
+    t = np.arange(npts) / sampling_rate - onset
+    wave = np.zeros(npts)
+    after = t >= 0
+    wave[after] = amplitude * np.sin(2 * np.pi * t[after] / 20.0) * (1 - np.exp(-t[after] / 5.0)) * np.exp(-t[after] / 90.0)
+    return wave
+
+
+def syntheticScenario(name):
+    #traces of the synthetic network for one scenario, the same for every run
+    rng = np.random.default_rng(sum(ord(c) for c in name))
+    traces = []
+    event = SCENARIO_LENGTH - 1200  # onset of the earthquake or glitch, in seconds after the start
+    for station, (channel, sampling_rate, delay, amplitude) in SYNTHETIC_STATIONS.items():
+        npts = int(SCENARIO_LENGTH * sampling_rate)
+        data = noise(rng, npts, sampling_rate)
+        if name == 'earthquake':
+            data += earthquake(npts, sampling_rate, event + delay, amplitude)
+        elif name == 'glitch' and station == 'BBB':
+            data[int(event * sampling_rate)] += 5e7
+        network, station_code, location, channel_code = channelToID(channel).split('.')
+        header = {'network': network, 'station': station_code, 'location': location, 'channel': channel_code,
+                  'sampling_rate': sampling_rate, 'starttime': SCENARIO_START}
+        if name == 'gap' and station == 'CCC':
+            cut = int(event * sampling_rate)
+            traces.append(Trace(data=data[:cut].copy(), header=header))
+            header = dict(header, starttime=SCENARIO_START + (cut + int(60 * sampling_rate)) / sampling_rate)
+            data = data[cut + int(60 * sampling_rate):]
+        traces.append(Trace(data=data, header=header))
+    return traces
+
+
+SCENARIOS = ('quiet', 'earthquake', 'glitch', 'gap')
+
+
+def runScenario(traces, pickets, filter_engine):
+    #replays the traces as fast as possible, returns the filtered data, the transitions and the costs
+    args = picketFenceArguments(filter_engine=filter_engine)
+    replay = picketFenceReplay(pickets, args, None, None, speed=0, verbose=False)
+    transitions = replay.replayTraces(traces)
+    filtStream = replay.engine.stream
+    filtered = {trace_id: (filtStream.buffers[trace_id].getData(), filtStream.buffers[trace_id].starttime.timestamp,
+                           filtStream.buffers[trace_id].sampling_rate) for trace_id in filtStream.getTraceIDs()}
+    stages = replay.engine.timer.summary().get('stages', {})
+    costs = {'replay': replay.wallTime, 'filter': stages['filter']['mean'] if 'filter' in stages else None}
+    return filtered, [(str(time), station, old, new) for time, station, old, new in transitions], costs
+
+
+def filePickets(paths):
+    #a picket for every station in the miniSEED files (or directories of them)
+    pickets = dict()
+    for path in paths:
+        for filename in sorted(glob.glob(os.path.join(path, '*'))) if os.path.isdir(path) else [path]:
+            for trace in read(filename, headonly=True):
+                stats = trace.stats
+                if stats.station not in pickets:
+                    pickets[stats.station] = {"Latitude": 0.0, "Longitude": 0.0, "PreferredServer": "", "index": str(len(pickets) + 1),
+                                              "Channel": "%s_%s:%s%s" % (stats.network, stats.station, stats.location, stats.channel)}
+    return pickets
+
+
+def scenarios(files):
+    #(name, traces, pickets) of the synthetic scenarios, or of the miniSEED files
+    if files:
+        pickets = filePickets(files)
+        yield 'files', readArchive(files, pickets), pickets
+        return
+    for name in SCENARIOS:
+        yield name, syntheticScenario(name), syntheticPickets()
+
+
+def record(filename, filter_engine, files):
+    arrays = dict()
+    meta = {'filter_engine': filter_engine, 'time': str(UTCDateTime()), 'scenarios': dict()}
+    for name, traces, pickets in scenarios(files):
+        filtered, transitions, costs = runScenario(traces, pickets, filter_engine)
+        for trace_id, (data, starttime, sampling_rate) in filtered.items():
+            arrays[name + "/" + trace_id + "/data"] = data
+            arrays[name + "/" + trace_id + "/info"] = np.array([sampling_rate, starttime])
+        meta['scenarios'][name] = {'transitions': transitions, 'costs': costs}
+        print("%s: %d channels, %d transitions, %.2f s" % (name, len(filtered), len(transitions), costs['replay']))
+        for transition in transitions:
+            print("    %s %s: %s -> %s" % tuple(transition))
+    arrays['meta'] = np.array(json.dumps(meta))
+    np.savez_compressed(filename, **arrays)
+
+
+def relativeError(data, starttime, sampling_rate, golden, goldenStart):
+    #largest difference over the samples that both have, relative to the largest golden value
+    offset = int(round((starttime - goldenStart) * sampling_rate))
+    first = max(offset, 0)
+    last = min(offset + len(data), len(golden))
+    if last <= first:
+        return np.inf
+    reference = golden[first:last]
+    difference = data[first - offset:last - offset] - reference
+    return float(np.max(np.abs(difference)) / max(np.max(np.abs(reference)), 1e-30))
+
+
+def stateLag(filter_engine, cycles=100, update_time=2.0):
+    #largest time between the end of the raw data of a channel and its saved filter state, over cycles where one 40 Hz
+    #channel gets 2 s every cycle and the other 10 s every 5 cycles, both with a jitter of up to 3 samples
+    args = picketFenceArguments(filter_engine=filter_engine, filter_init='steady')
+    rng = np.random.default_rng(3)
+    clock = simulatedClock(SCENARIO_START, speed=0)
+    stream = ringBufferStream(buffer_time=args.stream_time)
+    filtStream = filteredStream(stream, myargs=args, clock=clock)
+    sampling_rate = 40.0
+    channels = {'XX.LAG1..BHZ': 1, 'XX.LAG2..BHZ': 5}   # trace id -> cycles between its packets
+    written = {trace_id: 0 for trace_id in channels}
+    largest = 0.0
+    for cycle in range(1, cycles + 1):
+        now = SCENARIO_START + cycle * update_time
+        for trace_id, every in channels.items():
+            if cycle % every:
+                continue
+            npts = max(int(round((now - SCENARIO_START) * sampling_rate)) - int(rng.integers(0, 4)) - written[trace_id], 1)
+            network, station, location, channel = trace_id.split('.')
+            data = 100.0 * np.sin(2 * np.pi * 0.05 * (written[trace_id] + np.arange(npts)) / sampling_rate)
+            stream.appendTrace(Trace(data=data, header={'network': network, 'station': station, 'location': location, 'channel': channel,
+                                                        'sampling_rate': sampling_rate,
+                                                        'starttime': SCENARIO_START + written[trace_id] / sampling_rate}))
+            written[trace_id] += npts
+        clock.set(now)
+        filtStream.filterNewData()
+        if cycle > 2 * max(channels.values()):
+            for trace_id in channels:
+                if 'stateEndtime' in filtStream.customMetadata.get(trace_id, {}):
+                    largest = max(largest, stream.buffers[trace_id].endtime - filtStream.customMetadata[trace_id]['stateEndtime'])
+    return largest, max(channels.values()) * update_time
+
+
+def gapRepair(grace=20.0):
+    #gaps left in a channel downloaded from two servers: the first one misses every third packet, the other one sends
+    #them a few seconds later, except the last one (after the grace time, its gap is interpolated)
+    clock = simulatedClock(SCENARIO_START, speed=0)
+    stream = ringBufferStream(buffer_time=600, clock=clock)
+    stream.gapHold['XX.GAP..BHZ'] = grace
+    sampling_rate, npts = 40.0, 400
+    data = np.random.default_rng(4).standard_normal(30 * npts)
+    header = {'network': 'XX', 'station': 'GAP', 'location': '', 'channel': 'BHZ', 'sampling_rate': sampling_rate}
+    packets = [Trace(data=data[ii * npts:(ii + 1) * npts], header=dict(header, starttime=SCENARIO_START + ii * npts / sampling_rate))
+               for ii in range(30)]
+    for ii, packet in enumerate(packets):
+        clock.set(packet.stats.endtime)
+        if ii % 3 != 1:
+            stream.appendTrace(packet)
+        if ii % 3 == 2 and ii < 27:
+            clock.set(packet.stats.endtime + 5)
+            stream.appendTrace(packets[ii - 1])
+    stream.releaseHeld(clock.now() + grace)
+    buffer = stream.buffers['XX.GAP..BHZ']
+    repaired = np.array_equal(buffer.getData()[:27 * npts], data[:27 * npts])
+    return repaired, buffer.gapCount
+
+
+def check(filename, filter_engine, files, tolerance, reference=True):
+    golden = np.load(filename)
+    meta = json.loads(str(golden['meta']))
+    passed = True
+    for name, traces, pickets in scenarios(files):
+        if name not in meta['scenarios']:
+            print("%s: not in %s, skipped" % (name, filename))
+            continue
+        filtered, transitions, costs = runScenario(traces, pickets, filter_engine)
+        errors = dict()
+        for trace_id, (data, starttime, sampling_rate) in filtered.items():
+            key = name + "/" + trace_id
+            if key + "/data" not in golden:
+                errors[trace_id] = np.inf
+                continue
+            goldenRate, goldenStart = golden[key + "/info"]
+            errors[trace_id] = relativeError(data, starttime, sampling_rate, golden[key + "/data"], goldenStart)
+        goldenIDs = set(key.split('/')[1] for key in golden.files if key.startswith(name + "/"))
+        missing = goldenIDs - set(filtered.keys())
+        goldenTransitions = [tuple(transition) for transition in meta['scenarios'][name]['transitions']]
+        sameDecisions = goldenTransitions == [tuple(transition) for transition in transitions]
+        ok = sameDecisions and not missing and all(error <= tolerance for error in errors.values())
+        passed = passed and ok
+
+        print("%s: %s" % (name, "ok" if ok else "FAILED"))
+        for trace_id, error in sorted(errors.items()):
+            print("    %s: relative error %.2e%s" % (trace_id, error, "" if error <= tolerance else " > %.0e" % tolerance))
+        for trace_id in sorted(missing):
+            print("    %s: no filtered data" % trace_id)
+        if not sameDecisions:
+            print("    decisions differ:")
+            print("      golden (%s): %s" % (meta['filter_engine'], goldenTransitions))
+            print("      %s: %s" % (filter_engine, transitions))
+
+        #the speed of both engines, measured now on this machine
+        line = "    %s: replay %.2f s" % (filter_engine, costs['replay'])
+        if costs['filter'] is not None:
+            line += ", filter %.2f ms per cycle" % (1e3 * costs['filter'])
+        if reference:
+            referenceCosts = runScenario(traces, pickets, meta['filter_engine'])[2]
+            line += " | %s: replay %.2f s" % (meta['filter_engine'], referenceCosts['replay'])
+            if referenceCosts['filter'] is not None:
+                line += ", filter %.2f ms per cycle" % (1e3 * referenceCosts['filter'])
+            if costs['filter'] and referenceCosts['filter']:
+                line += " (filter %.1fx faster)" % (referenceCosts['filter'] / costs['filter'])
+        print(line)
+
+    lag, bound = stateLag(filter_engine)
+    print("state lag: %s, %.1f s behind the data at most (bound %.0f s)" % ("ok" if lag <= bound else "FAILED", lag, bound))
+    repaired, gaps = gapRepair()
+    print("gap repair: %s, %d gap interpolated (1 expected)" % ("ok" if repaired and gaps == 1 else "FAILED", gaps))
+    return passed and lag <= bound and repaired and gaps == 1
+
+
+def main():
+    parser = ArgumentParser(prog='Picket_fence_regression',
+                            description='Record or check golden filter and detection outputs of the picket fence',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--record', default=None, help='run the scenarios and save the results to this .npz file')
+    action.add_argument('--check', default=None, help='run the scenarios and compare them with this .npz file')
+    parser.add_argument('--filter-engine', default=None, choices=['sos', 'lsim'], dest='filter_engine',
+                        help='filter engine that is recorded or checked, None records lsim and checks the default of the picket fence')
+    parser.add_argument('--files', default=None, nargs='+',
+                        help='miniSEED files to use instead of the synthetic scenarios, the same for --record and --check')
+    parser.add_argument('--tolerance', default=1e-6, type=float,
+                        help='largest difference of the filtered data allowed, relative to its largest value')
+    parser.add_argument('--no-reference', default=False, action='store_true',
+                        help='do not time the engine of the golden data for the speed comparison')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if args.record is not None:
+        record(args.record, args.filter_engine or 'lsim', args.files)
+        return
+    filter_engine = args.filter_engine or picketFenceArguments().filter_engine
+    if not check(args.check, filter_engine, args.files, args.tolerance, reference=not args.no_reference):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay of archived miniSEED data through the picket fence, without any connection.
+
+The files are cut into packets that are handed to SeedlinkUpdater.handleTrace() in the order in which they would have
+arrived (by their end time), and the detection engine runs every 'update_time' seconds of the data time. Time is
+virtual, a simulatedClock that the replay steps: with speed N a day of data takes 1/N of a day, with speed 0 it runs as
+fast as the computer can. The station level changes are printed as they happen, together with the cost per packet and
+per detection cycle at the end, e.g.
+    python3 LHO-picket-fence.py --replay /data/2023-08-20/ --speed 60
+"""
+
+import heapq
+import copy
+import threading
+import logging
+import glob
+import os
+import time
+
+from obspy import Trace, read
+
+from Picket_fence_code_v2 import ringBufferStream, filteredStream, detectionEngine, packetDetector, SeedlinkUpdater, initEpics, \
+    simulatedClock, channelToID, createAssociator
+from Picket_fence_epics import createWriter
+
+
+def pickTraces(stream, picket_dict):
+    #keeps the traces of the picket channels, "NET_STA:LOCCHA" in the picket dict
+    wanted = set(channelToID(statInfo['Channel']) for statInfo in picket_dict.values())
+    return [trace for trace in stream if trace.id in wanted]
+
+
+def readArchive(paths, picket_dict):
+    #reads the miniSEED files (or directories of them) with data of the pickets
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, '*'))) if os.path.isdir(path) else [path]
+    traces = []
+    for filename in files:
+        try:
+            traces += pickTraces(read(filename), picket_dict)
+        except Exception as e:
+            logging.error("%s: %s" % (filename, e))
+    return traces
+
+
+def packets(trace, packet_length):
+    #cuts a trace into packets of 'packet_length' seconds, as (endtime, Trace) in time order
+    npts = max(int(round(packet_length * trace.stats.sampling_rate)), 1)
+    header = {'network': trace.stats.network, 'station': trace.stats.station, 'location': trace.stats.location,
+              'channel': trace.stats.channel, 'sampling_rate': trace.stats.sampling_rate}
+    for first in range(0, trace.stats.npts, npts):
+        data = trace.data[first:first + npts].astype('float64')
+        starttime = trace.stats.starttime + first * trace.stats.delta
+        yield starttime + (len(data) - 1) * trace.stats.delta, Trace(data=data, header=dict(header, starttime=starttime))
+
+
+class picketFenceReplay():
+    """
+    Runs the picket fence over archived data instead of SeedLink connections.
+    """
+    def __init__(self, picket_dict, myargs, epics_prefix, paths, speed=1.0, packet_length=10.0, backfill=None, verbose=True):
+        self.pickets = picket_dict
+        self.args = copy.copy(myargs)       # the caller's arguments are left as they are
+        self.args.epics_prefix = epics_prefix
+        self.paths = paths
+        self.speed = speed                  # virtual seconds per wall clock second, 0 runs as fast as possible
+        self.packet_length = packet_length  # seconds of data per packet
+        self.backfill = backfill            # seconds of data handed over before the first detection, like the SeedLink backfill
+                                            # (by default the filter transient plus the displayed time)
+        self.writer = createWriter(myargs.epics_backend, prefix=epics_prefix, picket_dict=picket_dict) if myargs.send_epics else None
+        self.verbose = verbose              # False does not print anything
+        self.transitions = []               # (time, station, old level, new level)
+        self.engine = None                  # detectionEngine of the last replay, its stream has the filtered data
+        self.detector = None                # packetDetector of the last replay, with packet_detection
+        self.wallTime = None                # duration of the last replay in seconds
+
+    def run(self):
+        traces = readArchive(self.paths, self.pickets)
+        if not traces:
+            print("No data of the pickets in", self.paths)
+            return
+        self.replayTraces(traces)
+
+    def replayTraces(self, traces):
+        #runs the detection over the traces, returns the station level transitions
+        self.transitions = []
+        start = min(trace.stats.starttime for trace in traces)
+        end = max(trace.stats.endtime for trace in traces)
+        clock = simulatedClock(start, speed=0)  ## stepped by the replay loop
+
+        lock = threading.Lock()
+        stream = ringBufferStream(buffer_time=self.args.stream_time)
+        filtStream = filteredStream(stream, myargs=self.args, clock=clock)
+        if self.backfill is None:
+            self.backfill = filtStream.startupTime + self.args.backtrace_time
+        clock.set(start + self.backfill)
+        engine = detectionEngine(filtStream, picket_dict=self.pickets, myargs=self.args, lock=lock, writer=self.writer, clock=clock,
+                                 associator=createAssociator(self.pickets, self.args))
+        self.engine = engine
+        self.detector = None
+        if self.args.packet_detection:
+            self.detector = packetDetector(filtStream, engine, lock)
+            self.detector.verbose = self.verbose
+        updater = SeedlinkUpdater(stream, myargs=self.args, lock=lock, detector=self.detector)
+        if self.args.send_epics:
+            initEpics(self.pickets, self.args.epics_prefix, self.writer)
+
+        arrivals = heapq.merge(*[packets(trace, self.packet_length) for trace in traces], key=lambda packet: packet[0])
+        if self.verbose:
+            print("Replaying %s - %s (%d channels)" % (start, end, len(traces)))
+
+        stepTime = clock.now()
+        wallStart = time.perf_counter()
+        packetCount, packetCost, stepCount, stepCost = 0, 0.0, 0, 0.0
+        levels = dict()
+        pending = next(arrivals, None)
+        while stepTime <= end + self.args.update_time:
+            #hand over the packets that arrived before the detection cycle
+            while pending is not None and pending[0] <= stepTime:
+                clock.set(max(pending[0], clock.now()))  ## the packet arrives with its last sample
+                t = time.perf_counter()
+                updater.handleTrace(pending[1])
+                packetCost += time.perf_counter() - t
+                packetCount += 1
+                pending = next(arrivals, None)
+
+            t = time.perf_counter()
+            clock.set(stepTime)
+            try:
+                engine.step(clock.now())
+            except Exception as e:
+                logging.error(e)
+            stepCost += time.perf_counter() - t
+            stepCount += 1
+            if engine.snapshot is not None:
+                for station, level in engine.snapshot['levels'].items():
+                    if levels.get(station, 'gray') != level:
+                        self.transitions.append((stepTime, station, levels.get(station, 'gray'), level))
+                        if self.verbose:
+                            print("%s %s: %s -> %s" % (stepTime.strftime("%Y-%m-%d %H:%M:%S"), station, levels.get(station, 'gray'), level))
+                levels = dict(engine.snapshot['levels'])
+
+            stepTime += self.args.update_time
+            if self.speed > 0:
+                delay = (stepTime - start - self.backfill) / self.speed - (time.perf_counter() - wallStart)
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.wallTime = time.perf_counter() - wallStart
+        if self.writer is not None:
+            self.writer.close()
+        if self.verbose:
+            self.printCosts(end - start, packetCount, packetCost, stepCount, stepCost)
+        return self.transitions
+
+    def printCosts(self, duration, packetCount, packetCost, stepCount, stepCost):
+        wall = self.wallTime
+        print("Replayed %.0f s of data in %.1f s (%.1fx)" % (duration, wall, duration / wall))
+        print("%d packets, %.1f us per packet" % (packetCount, 1e6 * packetCost / max(packetCount, 1)))
+        print("%d detection cycles, %.2f ms per cycle" % (stepCount, 1e3 * stepCost / max(stepCount, 1)))
+        for stage, stats in self.engine.timer.summary().get('stages', {}).items():
+            print("    %s: %.2f ms mean, %.2f ms max" % (stage, 1e3 * stats['mean'], 1e3 * stats['max']))
+        if self.detector is not None:
+            metrics = self.detector.metrics()
+            line = "%d packets checked on arrival, %d levels raised" % (metrics['packets'], metrics['alerts'])
+            if 'latency_ms' in metrics:
+                line += ", %.2f ms mean, %.2f ms max from arrival to decision" % (metrics['latency_ms']['mean'], metrics['latency_ms']['max'])
+            print(line)
+        for trace_id, metrics in sorted(self.engine.stream.startupMetrics().items()):
+            if metrics['time_to_first_valid'] is not None:
+                print("%s: first valid sample %.0f s after its first data (%.0f s of data discarded)" % (trace_id,
+                      metrics['time_to_first_valid'], metrics['blind_time']))
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local SeedLink server for testing the picket fence without a network.
+
+It speaks enough of the SeedLink protocol (v3, multi-station) for the ObsPy SeedLinkConnection used by the
+SeedlinkUpdater: HELLO, STATION, SELECT, DATA/FETCH/TIME, END and BYE. The data is served as 512 byte miniSEED
+records, each one behind the usual 8 byte "SL" + sequence number header. Every record has its own sequence number:
+the packets are numbered from the epoch and each one has a block of sequence numbers large enough for its records,
+so a client can resume at the record after the last one it got with "DATA <sequence number>" after a reconnection.
+
+The data comes either from synthetic generators (noise plus a microseism, for any station that is requested) or
+from miniSEED files, which are shifted in time so that their first sample is served at the time the emulator starts.
+Packet jitter, dropped packets (gaps), disconnects and a speed multiplier can be set from the command line, e.g.
+    python3 Picket_fence_seedlink_emulator.py --port 18000 --rate 40 --jitter 0.5 --gap-rate 0.01
+and the picket fence is pointed to it with
+    python3 LHO-picket-fence.py --seedlink-server localhost:18000
+
+With a speed above 1 the data runs ahead of the wall clock, so it is meant for throughput tests.
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from io import BytesIO
+import socketserver
+import threading
+import logging
+import zlib
+import glob
+import os
+import time
+
+import numpy as np
+from obspy import Trace, UTCDateTime, read
+
+RECORD_LENGTH = 512
+
+
+class emulatorClock():
+    """
+    Time of the emulator, it runs 'speed' times faster than the wall clock from the moment it is created.
+    """
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.wallStart = time.time()
+        self.start = UTCDateTime() if start is None else start
+
+    def now(self):
+        return self.start + (time.time() - self.wallStart) * self.speed
+
+
+class syntheticSource():
+    """
+    Noise plus a microseism for one channel. The phase and noise seed come from the channel id and the noise of a
+    sample only depends on its time, so a packet that is sent again after a reconnection has the same records.
+    """
+    def __init__(self, trace_id, sampling_rate, amplitude=1000.0):
+        self.id = trace_id
+        self.sampling_rate = sampling_rate
+        self.amplitude = amplitude
+        seed = zlib.crc32(trace_id.encode())
+        self.seed = seed
+        self.phase = (seed % 1000) / 1000 * 2 * np.pi
+
+    def read(self, starttime, npts):
+        t = starttime.timestamp + np.arange(npts) / self.sampling_rate
+        rng = np.random.default_rng([self.seed, int(round(starttime.timestamp * self.sampling_rate))])
+        data = self.amplitude * (np.sin(2 * np.pi * 0.15 * t + self.phase) + 0.3 * rng.standard_normal(npts))
+        return data
+
+
+class fileSource():
+    """
+    One channel of miniSEED files, shifted by 'offset' seconds. Times outside of the files read as zeros.
+    """
+    def __init__(self, trace, offset):
+        self.id = trace.id
+        self.sampling_rate = trace.stats.sampling_rate
+        self.trace = trace
+        self.offset = offset
+
+    def read(self, starttime, npts):
+        first = int(round((starttime - self.offset - self.trace.stats.starttime) * self.sampling_rate))
+        data = np.zeros(npts)
+        lo, hi = max(first, 0), min(first + npts, self.trace.stats.npts)
+        if lo < hi:
+            data[lo - first:hi - first] = self.trace.data[lo:hi]
+        return data
+
+
+class channelFeed():
+    """
+    Produces the miniSEED records of one channel for a connection, starting with the packet that contains 'starttime'.
+    """
+    def __init__(self, source, network, station, location, channel, starttime, packet_length):
+        self.source = source
+        self.header = {'network': network, 'station': station, 'location': location, 'channel': channel,
+                       'sampling_rate': source.sampling_rate}
+        self.npts = max(int(round(packet_length * source.sampling_rate)), 1)
+        self.duration = self.npts / source.sampling_rate
+        self.next = UTCDateTime(np.floor(starttime.timestamp / self.duration) * self.duration)
+        self.stride = self.npts // 100 + 1  # sequence numbers of a packet, a STEIM2 record holds at least 103 samples
+        self.skip = 0           # records of the next packet that the client already has
+        self.pending = None     # (release time, (sequence, records)) of a packet held back by the jitter
+
+    def resume(self, sequence, now):
+        #starts with the record 'sequence' (the one after the last the client got), the most recent one before 'now'
+        current = int(np.floor(now.timestamp / self.duration)) * self.stride
+        packet, self.skip = divmod(current - (current - sequence) % 0x1000000, self.stride)
+        self.next = UTCDateTime(packet * self.duration)
+
+    def due(self, now):
+        #True when a whole packet of data is older than 'now'
+        return self.next + self.npts / self.source.sampling_rate <= now
+
+    def records(self):
+        #returns the sequence number of the first record and the records of the next packet, the records that follow
+        #have the next sequence numbers
+        sequence = int(round(self.next.timestamp / self.duration)) * self.stride
+        data = np.round(self.source.read(self.next, self.npts)).astype(np.int32)
+        trace = Trace(data=data, header=dict(self.header, starttime=self.next))
+        self.next += self.npts / self.source.sampling_rate
+        buf = BytesIO()
+        trace.write(buf, format='MSEED', reclen=RECORD_LENGTH, encoding='STEIM2')
+        raw = buf.getvalue()
+        records = [raw[ii:ii + RECORD_LENGTH] for ii in range(0, len(raw), RECORD_LENGTH)][self.skip:]
+        sequence, self.skip = (sequence + self.skip) % 0x1000000, 0
+        return sequence, records
+
+
+def selectorMatches(selector, location, channel):
+    #SeedLink selectors are [LL]CCC[.T] with '?' wildcards, e.g. "00BHZ", "BHZ", "BH?.D"
+    selector = selector.split('.')[0]
+    pattern = selector if len(selector) == 5 else '??' + selector if len(selector) == 3 else None
+    if pattern is None:
+        return False
+    target = (location or '  ').ljust(2)[:2] + channel
+    return all(p == '?' or p == c for p, c in zip(pattern, target))
+
+
+def parseSeedlinkTime(text):
+    #SeedLink times look like 2023,08,30,11,36,15
+    return UTCDateTime(*[int(float(field)) for field in text.split(',')])
+
+
+class seedlinkEmulator(socketserver.ThreadingTCPServer):
+    """
+    SeedLink server, one thread per connection.
+
+    'sources' maps "NET.STA.LOC.CHA" to a data source, when it is None any requested station is served with
+    syntheticSource data at 'sampling_rate'.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, sources=None, sampling_rate=40.0, amplitude=1000.0, packet_length=1.0, jitter=0.0,
+                 gap_rate=0.0, disconnect_time=None, speed=1.0, clock=None):
+        super(seedlinkEmulator, self).__init__(address, seedlinkHandler)
+        self.sources = sources
+        self.sampling_rate = sampling_rate
+        self.amplitude = amplitude
+        self.packet_length = packet_length      # seconds of data in each packet
+        self.jitter = jitter                    # maximum random delay (in seconds) of a packet
+        self.gap_rate = gap_rate                # probability of dropping a packet
+        self.disconnect_time = disconnect_time  # mean time (in seconds) before a connection is dropped
+        self.clock = emulatorClock(speed) if clock is None else clock
+        self.rng = np.random.default_rng()
+        self.statsLock = threading.Lock()
+        self.packets = 0
+        self.bytes = 0
+
+    def findChannels(self, network, station, selectors):
+        #returns a list of (location, channel, source) for the station
+        if self.sources is None:
+            channels = []
+            for selector in selectors or ['BHZ']:
+                selector = selector.split('.')[0]
+                location, channel = (selector[:2].strip(), selector[2:]) if len(selector) == 5 else ('', selector)
+                if '?' in selector:
+                    continue
+                trace_id = '.'.join((network, station, location, channel))
+                channels.append((location, channel, syntheticSource(trace_id, self.sampling_rate, self.amplitude)))
+            return channels
+        channels = []
+        for trace_id, source in self.sources.items():
+            net, sta, loc, cha = trace_id.split('.')
+            if (net, sta) != (network, station):
+                continue
+            if selectors and not any(selectorMatches(selector, loc, cha) for selector in selectors):
+                continue
+            channels.append((loc, cha, source))
+        return channels
+
+    def hasStation(self, network, station):
+        if self.sources is None:
+            return True
+        return any(trace_id.split('.')[:2] == [network, station] for trace_id in self.sources)
+
+    def countPacket(self, nbytes):
+        with self.statsLock:
+            self.packets += 1
+            self.bytes += nbytes
+
+
+class seedlinkHandler(socketserver.BaseRequestHandler):
+
+    def readCommand(self):
+        #commands end with '\r' (or "\r\n")
+        while b'\r' not in self.buffer and b'\n' not in self.buffer:
+            chunk = self.request.recv(1024)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        line, sep, rest = self.buffer.replace(b'\r\n', b'\r').replace(b'\n', b'\r').partition(b'\r')
+        self.buffer = rest
+        return line.decode('ascii', 'replace').strip()
+
+    def handle(self):
+        server = self.server
+        self.buffer = b''
+        stations = []           # [network, station, selectors, start time]
+        endtime = None
+        while True:
+            command = self.readCommand()
+            if command is None:
+                return
+            words = command.split()
+            if not words:
+                continue
+            verb = words[0].upper()
+            logging.debug("%s: %s" % (self.client_address, command))
+            if verb == 'HELLO':
+                self.request.sendall(b"SeedLink v3.1 (Picket Fence emulator) :: SEEDLINK\r\nPicket Fence emulator\r\n")
+            elif verb == 'STATION' and len(words) >= 3:
+                if server.hasStation(words[2], words[1]):
+                    stations.append([words[2], words[1], [], None, None])
+                    self.request.sendall(b"OK\r\n")
+                else:
+                    self.request.sendall(b"ERROR\r\n")
+            elif verb == 'SELECT' and stations:
+                stations[-1][2].extend(words[1:])
+                self.request.sendall(b"OK\r\n")
+            elif verb in ('DATA', 'FETCH'):
+                #without a sequence number the data starts now
+                if len(words) > 1 and stations:
+                    try:
+                        stations[-1][4] = int(words[1], 16)
+                    except ValueError:
+                        self.request.sendall(b"ERROR\r\n")
+                        continue
+                self.request.sendall(b"OK\r\n")
+            elif verb == 'TIME' and len(words) >= 2:
+                try:
+                    starttime = parseSeedlinkTime(words[1])
+                    endtime = parseSeedlinkTime(words[2]) if len(words) > 2 else None
+                    for entry in stations:
+                        if entry[3] is None and entry[4] is None:
+                            entry[3] = starttime
+                except Exception:
+                    self.request.sendall(b"ERROR\r\n")
+                    continue
+                self.request.sendall(b"OK\r\n")
+            elif verb == 'END':
+                break
+            elif verb == 'BYE':
+                return
+            else:
+                self.request.sendall(b"ERROR\r\n")
+
+        now = server.clock.now()
+        feeds = []
+        for network, station, selectors, starttime, sequence in stations:
+            for location, channel, source in server.findChannels(network, station, selectors):
+                feed = channelFeed(source, network, station, location, channel,
+                                   now if starttime is None else max(starttime, now - 24 * 3600), server.packet_length)
+                if sequence is not None:
+                    feed.resume(sequence, now)
+                feeds.append(feed)
+        logging.info("%s: streaming %d channels" % (self.client_address, len(feeds)))
+        self.stream(feeds, endtime)
+
+    def stream(self, feeds, endtime):
+        server = self.server
+        disconnectAt = None
+        if server.disconnect_time:
+            disconnectAt = time.time() + server.rng.exponential(server.disconnect_time)
+        try:
+            while feeds:
+                now = server.clock.now()
+                if endtime is not None:
+                    now = min(now, endtime)
+                sent = False
+                for feed in feeds:
+                    while True:
+                        if feed.pending is None:
+                            if not feed.due(now):
+                                break
+                            packet = feed.records()
+                            if server.gap_rate and server.rng.random() < server.gap_rate:
+                                continue
+                            feed.pending = (now + server.rng.uniform(0, server.jitter), packet)
+                        if feed.pending[0] > now:
+                            break
+                        sequence, records = feed.pending[1]
+                        for ii, record in enumerate(records):
+                            self.request.sendall(b"SL%06X" % ((sequence + ii) % 0x1000000) + record)
+                            server.countPacket(len(record) + 8)
+                        feed.pending = None
+                        sent = True
+                if endtime is not None and all(feed.next >= endtime for feed in feeds):
+                    self.request.sendall(b"END")
+                    return
+                if disconnectAt is not None and time.time() > disconnectAt:
+                    logging.info("%s: dropping the connection" % (self.client_address,))
+                    return
+                if not sent:
+                    time.sleep(0.05)
+        except (BrokenPipeError, ConnectionResetError):
+            logging.info("%s: client disconnected" % (self.client_address,))
+
+
+def loadFileSources(paths, start):
+    #reads the miniSEED files (or directories of them) and shifts them so that their first sample is at 'start'
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, '*'))) if os.path.isdir(path) else [path]
+    stream = read(files[0])
+    for filename in files[1:]:
+        stream += read(filename)
+    stream.merge(fill_value='interpolate')
+    offset = start - min(trace.stats.starttime for trace in stream)
+    return {trace.id: fileSource(trace, offset) for trace in stream}
+
+
+def main():
+    parser = ArgumentParser(prog='Picket_fence_seedlink_emulator',
+                            description='Serve synthetic or archived data over SeedLink for testing the picket fence',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='localhost', help='address to listen on')
+    parser.add_argument('--port', default=18000, type=int, help='port to listen on')
+    parser.add_argument('--files', nargs='*', default=None,
+                        help='miniSEED files or directories to serve, without it any requested station gets synthetic data')
+    parser.add_argument('--rate', default=40.0, type=float, help='sampling rate (Hz) of the synthetic data')
+    parser.add_argument('--amplitude', default=1000.0, type=float, help='amplitude (counts) of the synthetic data')
+    parser.add_argument('--packet-length', default=1.0, type=float, dest='packet_length',
+                        help='seconds of data in each packet')
+    parser.add_argument('--jitter', default=0.0, type=float, help='maximum random delay (s) of the packets')
+    parser.add_argument('--gap-rate', default=0.0, type=float, dest='gap_rate',
+                        help='probability of dropping a packet')
+    parser.add_argument('--disconnect', default=None, type=float,
+                        help='mean time (s) before a connection is dropped, never by default')
+    parser.add_argument('--speed', default=1.0, type=float, help='speed of the emulated time')
+    parser.add_argument('--report', default=10.0, type=float, help='seconds between throughput reports')
+    parser.add_argument('-v', '--verbose', default=False, action="store_true", help='show the SeedLink commands')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    clock = emulatorClock(args.speed)
+    sources = loadFileSources(args.files, clock.start) if args.files else None
+    server = seedlinkEmulator((args.host, args.port), sources=sources, sampling_rate=args.rate, amplitude=args.amplitude,
+                              packet_length=args.packet_length, jitter=args.jitter, gap_rate=args.gap_rate,
+                              disconnect_time=args.disconnect, clock=clock)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("SeedLink emulator on %s:%d" % (args.host, args.port))
+    try:
+        while True:
+            packets, nbytes = server.packets, server.bytes
+            time.sleep(args.report)
+            print("%s: %.1f packets/s, %.1f kB/s" % (clock.now().strftime("%H:%M:%S"),
+                  (server.packets - packets) / args.report, (server.bytes - nbytes) / args.report / 1000))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Travel-time grid of the picket fence: where an earthquake is and when its waves reach the observatory.
+
+A grid of latitude/longitude nodes around the pickets and the observatory is computed once: for every node, the
+travel time of the waves that trigger the pickets to each picket and of the P, S and surface waves to the
+observatory. A constant velocity along the great circle is used, like the moveouts of the association. The tables
+are saved as .npy files (<prefix>_stations.npy, <prefix>_site.npy and <prefix>_grid.json) and read back memory-mapped,
+so a restart does not recompute them. They are rebuilt when the pickets, the observatory or the grid change.
+
+locate() searches the whole grid at once for the node whose travel times best explain the trigger times: the origin
+time of each node is the mean of the trigger times minus the travel times, and the node with the smallest RMS
+residual is the epicenter. With only two stations many nodes fit as well (a hyperbola); of the nodes within 'slack'
+seconds of the best fit, the one with the earliest arrival at the observatory is chosen, so the lead time is never
+overestimated.
+"""
+
+import logging
+import json
+import os
+
+import numpy as np
+
+from Picket_fence_association import haversine, PHASE_VELOCITIES
+
+
+class travelTimeGrid():
+    """
+    Travel times (s) from every node of the grid to the pickets (self.stations, nodes x pickets) and to the observatory
+    (self.site, nodes x phases).
+    """
+    def __init__(self, picket_dict, observatory, spacing=0.1, margin=5.0, velocities=PHASE_VELOCITIES,
+                 trigger_phase='surface', prefix=None):
+        self.names = sorted(picket_dict.keys())
+        self.index = {name: ii for ii, name in enumerate(self.names)}
+        self.coordinates = [[float(picket_dict[name]['Latitude']), float(picket_dict[name]['Longitude'])] for name in self.names]
+        self.observatory = [float(observatory[0]), float(observatory[1])]
+        self.spacing = spacing                  # degrees between the nodes
+        self.margin = margin                    # degrees around the pickets and the observatory
+        self.velocities = dict(velocities)
+        self.trigger_phase = trigger_phase      # phase that triggers the pickets
+        self.phases = sorted(self.velocities.keys())
+
+        latitudes = [lat for lat, lon in self.coordinates] + [self.observatory[0]]
+        longitudes = [lon for lat, lon in self.coordinates] + [self.observatory[1]]
+        self.latitudes = np.arange(max(min(latitudes) - margin, -90), min(max(latitudes) + margin, 90) + spacing / 2, spacing)
+        self.longitudes = np.arange(min(longitudes) - margin, max(longitudes) + margin + spacing / 2, spacing)
+
+        self.stations = None
+        self.site = None
+        if prefix is not None and self.load(prefix):
+            return
+        self.build()
+        if prefix is not None:
+            self.save(prefix)
+
+    def description(self):
+        #what the tables depend on, saved next to them
+        return {'names': self.names, 'coordinates': self.coordinates, 'observatory': self.observatory, 'spacing': self.spacing,
+                'margin': self.margin, 'velocities': self.velocities, 'trigger_phase': self.trigger_phase, 'phases': self.phases}
+
+    def build(self):
+        lat, lon = np.meshgrid(self.latitudes, self.longitudes, indexing='ij')
+        lat, lon = lat.ravel(), lon.ravel()
+        coordinates = np.array(self.coordinates).reshape(-1, 2)
+        distances = haversine(lat[:, None], lon[:, None], coordinates[None, :, 0], coordinates[None, :, 1])
+        self.stations = (distances / self.velocities[self.trigger_phase]).astype(np.float32)
+        siteDistances = haversine(lat, lon, self.observatory[0], self.observatory[1])
+        self.site = np.stack([siteDistances / self.velocities[phase] for phase in self.phases], axis=1).astype(np.float32)
+
+    def save(self, prefix):
+        try:
+            np.save(prefix + "_stations.npy", self.stations)
+            np.save(prefix + "_site.npy", self.site)
+            with open(prefix + "_grid.json", 'w') as f:
+                json.dump(self.description(), f)
+        except Exception as e:
+            logging.error("could not save the travel-time grid: %s" % e)
+
+    def load(self, prefix):
+        #memory-maps the tables if they were computed for the same pickets, observatory and grid
+        try:
+            if not os.path.exists(prefix + "_grid.json"):
+                return False
+            with open(prefix + "_grid.json") as f:
+                if json.load(f) != json.loads(json.dumps(self.description())):
+                    return False
+            stations = np.load(prefix + "_stations.npy", mmap_mode='r')
+            site = np.load(prefix + "_site.npy", mmap_mode='r')
+        except Exception as e:
+            logging.error("could not read the travel-time grid: %s" % e)
+            return False
+        nodes = len(self.latitudes) * len(self.longitudes)
+        if stations.shape != (nodes, len(self.names)) or site.shape != (nodes, len(self.phases)):
+            return False
+        self.stations, self.site = stations, site
+        return True
+
+    def locate(self, stations, times, slack=1.0):
+        """
+        Epicenter of the triggers of 'stations' at 'times' (POSIX times).
+        :return: {'latitude', 'longitude', 'origin', 'rms', 'site_arrival': {phase: POSIX time}}, None without triggers
+        """
+        columns = [self.index[station] for station in stations if station in self.index]
+        times = np.array([time for station, time in zip(stations, times) if station in self.index], dtype=np.float64)
+        if len(columns) == 0:
+            return None
+        reference = times.min()
+        residuals = (times - reference)[None, :] - self.stations[:, columns]
+        origins = residuals.mean(axis=1)
+        rms = np.sqrt(((residuals - origins[:, None]) ** 2).mean(axis=1))
+        siteArrival = origins + self.site[:, self.phases.index(self.trigger_phase)]
+        candidates = np.flatnonzero(rms <= rms.min() + slack)
+        node = candidates[np.argmin(siteArrival[candidates])]
+        row, column = divmod(int(node), len(self.longitudes))
+        return {'latitude': float(self.latitudes[row]), 'longitude': float(self.longitudes[column]),
+                'origin': float(reference + origins[node]), 'rms': float(rms[node]),
+                'site_arrival': {phase: float(reference + origins[node] + self.site[node, ii]) for ii, phase in enumerate(self.phases)}}